@@ -4,34 +4,57 @@ from collections import Mapping, Iterable
 
 from jsonmapping.transforms import transliterate
 
+from loom.util import LRUCache
+
 IGNORE_FIELDS = ['$schema', '$sources', '$latin', '$text', '$attrcount',
                  '$linkcount', 'id']
 
+# Transliterated forms of recently seen strings. The size can be changed
+# using ``configure_cache``.
+latin_cache = LRUCache(100000)
+
+
+def configure_cache(size):
+    """ Replace the transliteration cache by one of the given size. """
+    global latin_cache
+    latin_cache = LRUCache(size)
+
 
 def latinize(text):
     """ Transliterate text to latin. """
     if text is None or not len(text):
         return text
-    return transliterate(text).lower()
+    latin = latin_cache.get(text)
+    if latin is None:
+        latin = transliterate(text).lower()
+        latin_cache.set(text, latin)
+    return latin
 
 
 def extract_text(data):
-    """ Get all the instances of text from a given object, recursively. """
-    if isinstance(data, Mapping):
-        values = []
-        for k, v in data.items():
-            if k in IGNORE_FIELDS:
-                continue
-            values.append(v)
-        data = values
-    if isinstance(data, (date, datetime)):
-        data = data.isoformat()
-    elif isinstance(data, (int, float)):
-        data = six.text_type(data)
-    if isinstance(data, six.string_types):
-        return [data]
-    if isinstance(data, Iterable):
-        values = []
-        for d in data:
-            values.extend(extract_text(d))
-        return values
+    """ Get all the distinct instances of text from a given object, in the
+    order they appear. Nested objects are walked using a stack rather than
+    recursion. """
+    texts, seen = [], set()
+    stack = [iter((data,))]
+    while len(stack):
+        try:
+            item = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        if isinstance(item, Mapping):
+            stack.append(v for (k, v) in six.iteritems(item)
+                         if k not in IGNORE_FIELDS)
+            continue
+        if isinstance(item, (date, datetime)):
+            item = item.isoformat()
+        elif isinstance(item, (int, float)):
+            item = six.text_type(item)
+        if isinstance(item, six.string_types):
+            if item not in seen:
+                seen.add(item)
+                texts.append(item)
+        elif isinstance(item, Iterable):
+            stack.append(iter(item))
+    return texts
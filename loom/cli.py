@@ -4,7 +4,7 @@ import click
 
 
 from loom.util import LoomException, load_config
-from loom.db import Source
+from loom.db import Source, migrate
 from loom.config import Config
 from loom.loader import Mapper, Spec
 from loom.indexer import Indexer
@@ -26,7 +26,10 @@ def cli(ctx, debug, config_file):
 
     config = load_config(config_file)
     ctx.obj['CONFIG'] = Config(config, path=config_file)
-    ctx.obj['CONFIG'].setup()
+    try:
+        ctx.obj['CONFIG'].setup(check=ctx.invoked_subcommand != 'upgrade')
+    except LoomException as le:
+        raise click.ClickException(le.message)
 
     fmt = '[%(levelname)-8s] %(name)-12s: %(message)s'
     level = logging.DEBUG if debug else logging.INFO
@@ -38,15 +41,29 @@ def cli(ctx, debug, config_file):
 
 @cli.command('map')
 @click.argument('spec_file', type=click.Path(exists=True))
+@click.option('--workers', '-w', default=1, type=int,
+              help='Number of processes used to map each mapping')
+@click.option('--concurrency', default=1, type=int,
+              help='Number of mappings which are run at the same time')
+@click.option('--full', is_flag=True, default=False,
+              help='Ignore watermarks and map all records')
+@click.option('--pipeline', is_flag=True, default=False,
+              help='Fetch, map and write records in parallel threads')
+@click.option('--bulk', is_flag=True, default=False,
+              help='Drop indexes during the load and re-create them after')
 @click.pass_context
-def map(ctx, spec_file):
+def map(ctx, spec_file, workers, concurrency, full, pipeline, bulk):
     """ Map data from the database into modeled objects. """
     try:
         config = ctx.obj['CONFIG']
         spec = load_config(spec_file)
         spec = Spec(config, spec, path=spec_file)
+        if pipeline:
+            spec['pipeline'] = True
 
-        mapper = Mapper(config, spec)
+        mapper = Mapper(config, spec, workers=workers,
+                        concurrency=concurrency, incremental=not full,
+                        bulk=bulk)
         mapper.map()
     except LoomException as le:
         raise click.ClickException(le.message)
@@ -57,14 +74,22 @@ def map(ctx, spec_file):
               help='Index only entities of the given type')
 @click.option('source', '-s', '--source', default=None,
               help='Index only entities from the given source')
+@click.option('--workers', '-w', default=1, type=int,
+              help='Number of processes used to index each type')
+@click.option('--incremental', '-i', is_flag=True, default=False,
+              help='Only index entities changed since the last run')
+@click.option('--rebuild', is_flag=True, default=False,
+              help='Build a new index and swap it in when complete')
 @click.pass_context
-def index(ctx, schema, source):
+def index(ctx, schema, source, workers, incremental, rebuild):
     """ Index modeled objects to ElasticSearch. """
     try:
         config = ctx.obj['CONFIG']
-        indexer = Indexer(config)
-        indexer.configure()
-        indexer.index(schema=schema, source=source)
+        indexer = Indexer(config, workers=workers)
+        if not rebuild:
+            indexer.configure()
+        indexer.index(schema=schema, source=source, incremental=incremental,
+                      rebuild=rebuild)
     except LoomException as le:
         raise click.ClickException(le.message)
 
@@ -88,8 +113,7 @@ def flush(ctx, source, flush_all):
             source_id = source_obj.id
         elif source_obj is None and source is not None:
             raise click.ClickException("No such source: %r" % source)
-        config.types.delete(source_id=source_id)
-        config.properties.delete(source_id=source_id)
+        config.entities.flush(source_id=source_id)
     except LoomException as le:
         raise click.ClickException(le.message)
 
@@ -99,26 +123,23 @@ def flush(ctx, source, flush_all):
 def dedupe(ctx):
     """ De-duplicate statements inside the statement DB. """
     config = ctx.obj['CONFIG']
-    if not config.is_postgresql:
-        msg = "De-dupe is only support with PostgreSQL"
-        raise click.ClickException(msg)
     conn = config.engine.connect()
-    dedupe_q = """DELETE FROM entity WHERE id IN (
-        SELECT id FROM (
-            SELECT id, ROW_NUMBER() OVER (partition BY subject, schema,
-                source_id, collection_id, author
-            ORDER BY id) AS rnum
-        FROM entity) t
-        WHERE t.rnum > 1);"""
-    conn.execute(dedupe_q)
-    dedupe_q = """DELETE FROM property WHERE id IN (
-        SELECT id FROM (
-            SELECT id, ROW_NUMBER() OVER (partition BY subject, predicate, object,
-                source_id, collection_id, author
-            ORDER BY id) AS rnum
-        FROM property) t
-        WHERE t.rnum > 1);"""
-    conn.execute(dedupe_q)
+    try:
+        for table in [config.types, config.properties]:
+            table.dedupe(conn)
+    finally:
+        conn.close()
+
+
+@cli.command('upgrade')
+@click.pass_context
+def upgrade(ctx):
+    """ Upgrade a statement DB created by an earlier version of loom. """
+    try:
+        migrate.upgrade(ctx.obj['CONFIG'])
+    except LoomException as le:
+        raise click.ClickException(le.message)
+
 
 if __name__ == '__main__':
     cli(obj={})
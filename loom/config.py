@@ -5,11 +5,14 @@ import urlparse
 from normality import slugify
 from sqlalchemy import create_engine
 from jsonschema import RefResolver
-from jsonmapping import SchemaVisitor
 from elasticsearch import Elasticsearch
 
 from loom.db import EntityManager, TableManager, Property, Entity
+from loom.db import TermManager
+from loom.db.partition import create_partitioned
+from loom.db.migrate import is_outdated
 from loom.db import session, Base
+from loom.registry import SchemaRegistry
 from loom.util import ConfigException, EnvMapping
 
 log = logging.getLogger(__name__)
@@ -38,9 +41,21 @@ class Config(EnvMapping):
     def is_postgresql(self):
         return 'postgres' in self.engine.dialect.name
 
-    def setup(self):
+    def setup(self, check=True):
+        """ Create any missing tables. Unless ``check`` is false, fail if
+        the statement tables need to be upgraded first. """
+        if check:
+            for manager in [self.types, self.properties]:
+                if is_outdated(manager):
+                    raise ConfigException("The table %r was created by an "
+                                          "older version of loom, run 'loom "
+                                          "upgrade' to update it."
+                                          % manager.name)
         session.configure(bind=self.engine)
         Base.metadata.bind = self.engine
+        if self.is_postgresql and self.get('partition_by_source'):
+            for table in [Entity.__table__, Property.__table__]:
+                create_partitioned(self.engine, table)
         Base.metadata.create_all()
 
     @property
@@ -49,6 +64,12 @@ class Config(EnvMapping):
             self._entities = EntityManager(self)
         return self._entities
 
+    @property
+    def terms(self):
+        if not hasattr(self, '_terms'):
+            self._terms = TermManager(self)
+        return self._terms
+
     @property
     def types(self):
         if not hasattr(self, '_types'):
@@ -97,29 +118,27 @@ class Config(EnvMapping):
         for uri in self.schemas.values():
             self.resolver.resolve(uri)
 
-    def _check_match(self, visitor, schema_uri):
-        if visitor.id == schema_uri:
-            return True
-        for parent in visitor.inherited:
-            if self._check_match(parent, schema_uri):
-                return True
-        return False
+    @property
+    def registry(self):
+        if not hasattr(self, '_registry'):
+            self.load_schemas()
+            self._registry = SchemaRegistry(self.resolver)
+        return self._registry
 
     def implied_schemas(self, schema_uri):
-        """ Given a schema URI, return a list of implied (i.e. child) schema URIs,
-        with the original schema included. """
-        self.load_schemas()
-        schemas = [schema_uri]
-        for uri, data in self.resolver.store.items():
-            if isinstance(data, dict):
-                visitor = SchemaVisitor(data, self.resolver)
-                if self._check_match(visitor, schema_uri):
-                    schemas.append(data.get('id'))
-        return schemas
+        """ Given a schema URI, return a list of implied (i.e. child) schema
+        URIs, with the original schema included. """
+        return self.registry.implied_schemas(schema_uri)
+
+    def is_a(self, schema_uri, parent_uri):
+        """ Check if a schema is the same as, or inherits from, another. """
+        return self.registry.is_a(schema_uri, parent_uri)
 
     def add_schema(self, schema):
         if 'id' in schema and schema['id'] not in self.resolver.store:
             self.resolver.store[schema['id']] = schema
+            if hasattr(self, '_registry'):
+                self._registry.invalidate()
 
     def get_alias(self, schema):
         """ Slightly hacky way of getting a slug-like name for a schema. This
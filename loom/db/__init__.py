@@ -1,7 +1,11 @@
 from loom.db.util import session, Base  # noqa
 from loom.db.source import Source  # noqa
+from loom.db.watermark import Watermark  # noqa
 from loom.db.property import Property  # noqa
 from loom.db.entity import Entity  # noqa
+from loom.db.term import Term, TermManager  # noqa
+from loom.db.tombstone import Tombstone  # noqa
 from loom.db.collection import Collection, CollectionSubject  # noqa
 from loom.db.entity_manager import EntityManager, EntityRight  # noqa
-from loom.db.manager import TableManager  # noqa
+from loom.db.manager import TableManager, create_indexes  # noqa
+from loom.db.async_entity_manager import AsyncEntityManager  # noqa
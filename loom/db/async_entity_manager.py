@@ -0,0 +1,100 @@
+import logging
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+from loom.db.entity_manager import BATCH_SIZE
+
+log = logging.getLogger(__name__)
+
+
+class AsyncEntityManager(object):
+    """ Run the operations of an entity manager in a pool of threads, so a
+    web backend can wait on them without blocking a worker, or issue several
+    at once. Each method returns an ``AsyncResult``, which holds the result
+    once ``get()`` is called on it.
+
+    Independent queries needed by a single operation, such as the batches of
+    nested subjects at one depth level, are run concurrently in a second
+    pool. Each thread uses its own connection from the engine's pool, so the
+    pool size should not exceed the number of available connections. """
+
+    def __init__(self, manager, threads=None):
+        self.manager = manager
+        self.config = manager.config
+        threads = int(threads or self.config.get('async_threads') or 5)
+        self.pool = ThreadPool(processes=threads)
+        self.fetchers = ThreadPool(processes=threads)
+
+    def _load(self, subjects, right=None):
+        """ Load the statements of a set of subjects, with each batch of
+        subjects fetched concurrently. """
+        subjects = list(subjects)
+        batches = [subjects[i:i + BATCH_SIZE]
+                   for i in range(0, len(subjects), BATCH_SIZE)]
+        if len(batches) < 2:
+            return self.manager.load_statements(subjects, right=right)
+
+        def load(batch):
+            return self.manager.load_statements(batch, right=right)
+
+        statements = {}
+        for part in self.fetchers.imap_unordered(load, batches):
+            statements.update(part)
+        return statements
+
+    def _get(self, subject, schema=None, depth=1, right=None):
+        pending = None
+        if schema is None:
+            # The schema lookup and the statements of the root subject do
+            # not depend on each other.
+            pending = self.fetchers.apply_async(self.manager.get_schema,
+                                                (subject,), {'right': right})
+        loader = self.manager.make_batch_loader(right, [subject], depth=depth,
+                                                load=self._load)
+        if pending is not None:
+            schema = pending.get()
+        if schema is None:
+            return
+        visitor = self.manager.get_statements_visitor(schema)
+        return visitor.objectify(loader, subject, depth=depth)
+
+    def get(self, subject, schema=None, depth=1, right=None):
+        """ Get an object representation of an entity, see
+        ``EntityManager.get``. """
+        return self.pool.apply_async(self._get, (subject,), {
+            'schema': schema,
+            'depth': depth,
+            'right': right
+        })
+
+    def get_schema(self, subject, right=None):
+        return self.pool.apply_async(self.manager.get_schema, (subject,),
+                                     {'right': right})
+
+    def get_schemas(self, subjects, right=None):
+        return self.pool.apply_async(self.manager.get_schemas, (subjects,),
+                                     {'right': right})
+
+    def _subjects(self, limit, args, kwargs):
+        subjects = self.manager.subjects(*args, **kwargs)
+        return list(islice(subjects, limit))
+
+    def subjects(self, *args, **kwargs):
+        """ Get a list of entity IDs and schemas, see
+        ``EntityManager.subjects``. Use ``limit`` and ``after`` to page
+        through the subjects. """
+        limit = kwargs.pop('limit', None)
+        return self.pool.apply_async(self._subjects, (limit, args, kwargs))
+
+    def save(self, schema, data, **kwargs):
+        return self.pool.apply_async(self.manager.save, (schema, data),
+                                     kwargs)
+
+    def remove(self, subject, **kwargs):
+        return self.pool.apply_async(self.manager.remove, (subject,), kwargs)
+
+    def close(self):
+        """ Wait for all pending operations and stop the threads. """
+        for pool in (self.pool, self.fetchers):
+            pool.close()
+            pool.join()
@@ -7,18 +7,30 @@ class Entity(Base):
     """ Type declarations for type declarations. """
     __tablename__ = 'entity'
     __table_args__ = (
-        Index('ix_entity_subject', 'subject'),
+        # Covers the columns needed to determine the schema of a subject,
+        # allowing for index-only scans on PostgreSQL:
+        Index('ix_entity_subject_created_at', 'subject', 'created_at',
+              info={'include': ['schema', 'source_id', 'collection_id',
+                                'author']}),
         Index('ix_entity_schema', 'schema'),
-        Index('ix_entity_source_id', 'source_id')
+        Index('ix_entity_source_id', 'source_id'),
+        Index('ix_entity_created_at', 'created_at'),
+        Index('ix_entity_hash', 'hash', unique=True)
     )
 
+    # The columns which identify a distinct type declaration:
+    KEY = ('subject', 'schema', 'source_id', 'collection_id', 'author')
+    # Columns which reference interned terms, rather than holding values:
+    TERMS = ('schema', 'author')
+
     id = Column(BigIntegerType, primary_key=True)
     subject = Column(Unicode(1024))
-    schema = Column(Unicode(255))
+    schema = Column(Integer)
     source_id = Column(Integer, nullable=True)
     collection_id = Column(Integer, nullable=True)
-    author = Column(Unicode(512), nullable=True)
+    author = Column(Integer, nullable=True)
     created_at = Column(DateTime, default=func.now(), nullable=True)
+    hash = Column(Unicode(32), nullable=True)
 
     def __repr__(self):
         return '<Entity(%r,%r)>' % (self.subject, self.schema)
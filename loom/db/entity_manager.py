@@ -1,37 +1,57 @@
 import logging
+from zlib import crc32
 from datetime import datetime
-from itertools import groupby
 
 from sqlalchemy.sql.expression import select
 from sqlalchemy.sql import bindparam
-from sqlalchemy import or_
-from jsonmapping import StatementsVisitor, TYPE_SCHEMA
+from sqlalchemy import or_, false, func, cast, literal, BigInteger
+from jsonmapping import StatementsVisitor, TYPE_SCHEMA, TYPE_LINK
 
 from loom.db.collection import CollectionSubject
+from loom.db.tombstone import Tombstone
+from loom.util import LRUCache
 
 
 log = logging.getLogger(__name__)
 
+# The maximum number of subjects fetched in one ``IN (...)`` query.
+BATCH_SIZE = 500
+# The number of rights for which the statements of a subject are cached.
+RIGHTS_PER_SUBJECT = 8
+
 
 class EntityRight(object):
     """ An access control object for a given entity/statement. """
 
     def __init__(self, collections=None, sources=None, author=None):
-        self.collections = set([c for c in collections if c is not None])
-        self.sources = set([s for s in sources if s is not None])
+        self.collections = set([c for c in collections or []
+                                if c is not None])
+        self.sources = set([s for s in sources or [] if s is not None])
         self.author = author
 
-    def check(self, stmt):
-        if self.collections is not None \
-                and stmt.collection_id in self.collections:
-            return True
-        if self.sources is not None \
-                and stmt.source_id in self.sources:
+    def check(self, stmt, terms=None):
+        """ Check a single statement in Python. The entity manager applies
+        rights in its queries instead. Rows from the statement tables hold
+        the term ID of their author, so the ``TermManager`` of the config
+        must be given to check those. """
+        if stmt.collection_id in self.collections:
             return True
-        if self.author is not None and stmt.author == self.author:
+        if stmt.source_id in self.sources:
             return True
+        if self.author is not None:
+            author = stmt.author
+            if terms is not None:
+                author = terms.decode(author)
+            if author == self.author:
+                return True
         return False
 
+    @property
+    def key(self):
+        """ A hashable value which identifies the scope of this right. """
+        return (frozenset(self.collections), frozenset(self.sources),
+                self.author)
+
 
 class EntityManager(object):
     """ Handle basic operations on entities. """
@@ -39,41 +59,127 @@ class EntityManager(object):
     def __init__(self, config):
         self.config = config
         self.visitors = {}
+        self.cache = LRUCache(config.get('statement_cache') or 0)
+        self.queries = {}
+
+    def _property_query(self, batch=False):
+        """ Generate a query for the property statements of a subject, or of
+        a set of subjects, in the order they were created. """
+        table = self.config.properties.table
+        q = select([table.c.subject, table.c.predicate, table.c.object,
+                    table.c.type, table.c.source_id, table.c.collection_id,
+                    table.c.author])
+        if batch:
+            subjects = bindparam('subjects', expanding=True)
+            q = q.where(table.c.subject.in_(subjects))
+        else:
+            q = q.where(table.c.subject == bindparam('subject'))
+        order_by = table.c.created_at.asc()
+        if self.config.is_postgresql:
+            order_by = order_by.nullsfirst()
+        return q.order_by(order_by)
+
+    def _statements(self, rows):
+        """ Convert property rows into the statement form expected by the
+        ``jsonmapping`` loader, skipping duplicate rows. """
+        terms = self.config.terms
+        unique = set()
+        for row in rows:
+            items = tuple(row.items())
+            if items in unique:
+                continue
+            unique.add(items)
+            yield {
+                'predicate': terms.decode(row.predicate),
+                'object': row.object,
+                'type': row.type,
+                'source': row.source_id,
+                'collection': row.collection_id,
+                'author': terms.decode(row.author)
+            }
+
+    def _cached(self, subject, right):
+        """ Get the cached statements of a subject, as seen with the given
+        right. The cache holds the statements for a few rights per subject,
+        so all of them can be invalidated at once. """
+        entry = self.cache.get(subject)
+        if entry is not None:
+            return entry.get(None if right is None else right.key)
+
+    def _store(self, subject, right, stmts):
+        key = None if right is None else right.key
+        entry = self.cache.setdefault(subject, {})
+        if key not in entry and len(entry) >= RIGHTS_PER_SUBJECT:
+            entry.clear()
+        entry[key] = stmts
+
+    def invalidate(self, subject):
+        """ Remove any cached statements of the given subject. """
+        self.cache.discard(subject)
 
     def make_loader(self, right):
         """ This is used when loading an object. It will be called for the
         root entity and any nested entities, so it's a major performance
         bottleneck. """
-        if not hasattr(self, '_pq'):
-            table = self.config.properties.table
-            q = select([table.c.predicate, table.c.object, table.c.type,
-                        table.c.source_id, table.c.collection_id,
-                        table.c.author])
-            q = q.where(table.c.subject == bindparam('subject'))
-            order_by = table.c.created_at.asc()
-            if self.config.is_postgresql:
-                order_by = order_by.nullsfirst()
-            q = q.order_by(order_by)
-            self._pq = q.compile(self.config.engine)
+        q, params = self._prepare('property', right)
 
         def _loader(subject):
-            rp = self.config.engine.execute(self._pq, subject=subject)
-            unique = set()
+            stmts = self._cached(subject, right)
+            if stmts is None:
+                rp = self.config.engine.execute(q, subject=subject, **params)
+                stmts = list(self._statements(rp.fetchall()))
+                self._store(subject, right, stmts)
+            return stmts
+        return _loader
+
+    def load_statements(self, subjects, right=None):
+        """ Fetch the statements of all the given subjects, in as few queries
+        as possible. Returns a dict of statement lists, keyed by subject. """
+        q, params = self._prepare('property', right, batch=True)
+        statements, rows = {}, {}
+        for subject in subjects:
+            stmts = self._cached(subject, right)
+            if stmts is None:
+                rows[subject] = []
+            else:
+                statements[subject] = stmts
+        missing = list(rows.keys())
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = missing[i:i + BATCH_SIZE]
+            rp = self.config.engine.execute(q, subjects=batch, **params)
             for row in rp.fetchall():
-                if right is not None and not right.check(row):
-                    continue
-                items = tuple(row.items())
-                if items in unique:
-                    continue
-                unique.add(items)
-                yield {
-                    'predicate': row.predicate,
-                    'object': row.object,
-                    'type': row.type,
-                    'source': row.source_id,
-                    'collection': row.collection_id,
-                    'author': row.author
-                }
+                rows[row.subject].append(row)
+        for subject, subject_rows in rows.items():
+            stmts = list(self._statements(subject_rows))
+            self._store(subject, right, stmts)
+            statements[subject] = stmts
+        return statements
+
+    def make_batch_loader(self, right, subjects, depth=1, load=None):
+        """ Make a loader which prefetches the statements of the given
+        subjects, and of the entities they link to, up to the given depth.
+        This issues one query per level, instead of one per subject. Any
+        subject which was not prefetched is loaded on its own. A different
+        function to fetch the statements of each level can be given as
+        ``load``. """
+        load = load or self.load_statements
+        cache = {}
+        level = set(subjects)
+        for i in range(depth):
+            cache.update(load(level, right=right))
+            if i == depth - 1:
+                break
+            level = set([stmt['object'] for s in level for stmt in cache[s]
+                         if stmt['type'] == TYPE_LINK])
+            level = level.difference(cache.keys())
+            if not len(level):
+                break
+        fallback = self.make_loader(right)
+
+        def _loader(subject):
+            if subject not in cache:
+                cache[subject] = fallback(subject)
+            return cache[subject]
         return _loader
 
     def get_statements_visitor(self, schema_uri):
@@ -119,22 +225,29 @@ class EntityManager(object):
         return properties, types
 
     def _filter_properties(self, properties, right):
-        loader = self.make_loader(right)
-        for subject, props in groupby(properties, lambda p: p.get('subject')):
-            current = {}
-            for stmt in loader(subject):
-                current[stmt['predicate']] = stmt['object']
-            for prop in props:
-                if prop['predicate'] not in current:
-                    yield prop
-                if prop['object'] != current.get(prop['predicate']):
-                    yield prop
+        """ Skip property statements whose value is already current. The
+        statements of all subjects are fetched in bulk. """
+        subjects = set([p.get('subject') for p in properties])
+        statements = self.load_statements(subjects, right=right)
+        current = {}
+        for subject, stmts in statements.items():
+            current[subject] = {}
+            for stmt in stmts:
+                current[subject][stmt['predicate']] = stmt['object']
+        for prop in properties:
+            values = current[prop.get('subject')]
+            if prop['predicate'] not in values or \
+                    prop['object'] != values[prop['predicate']]:
+                yield prop
 
     def _filter_types(self, types, right):
+        subjects = set([t['subject'] for t in types])
+        schemas = self.get_schemas(subjects, right=right)
         for t in types:
-            schema = self.get_schema(t['subject'], right=right)
+            schema = schemas.get(t['subject'])
             if schema is None:
                 yield t
+                continue
             if t['schema'] == schema:
                 continue
             if t['schema'] in self.config.implied_schemas(schema):
@@ -155,13 +268,20 @@ class EntityManager(object):
             self.config.types.insert_many(types)
         if len(properties):
             self.config.properties.insert_many(properties)
+        for stmt in types + properties:
+            self.invalidate(stmt['subject'])
         if len(types):
             return types[0]['subject']
         return data.get('id')
 
     def remove(self, subject, source_id=None, collection_id=None,
                author=None):
-        """ Remove statements matching given criteria from the database. """
+        """ Remove statements matching given criteria from the database. A
+        tombstone is kept for the subject, so it is updated or removed by the
+        next incremental indexing run. """
+        tombstone = {'subject': subject, 'source_id': source_id,
+                     'created_at': datetime.utcnow()}
+        self.config.engine.execute(Tombstone.__table__.insert(), tombstone)
         for table in [self.config.types, self.config.properties]:
             where = {'subject': subject}
             if source_id is not None:
@@ -171,38 +291,117 @@ class EntityManager(object):
             if author is not None:
                 where['author'] = author
             table.delete(**where)
+        self.invalidate(subject)
+
+    def flush(self, source_id=None):
+        """ Remove all statements from the given source, or all statements
+        if no source is given. Tombstones are kept for the subjects of all
+        the removed type statements. """
+        table = self.config.types.table
+        q = select([table.c.subject, table.c.source_id,
+                    literal(datetime.utcnow())]).distinct()
+        if source_id is not None:
+            q = q.where(table.c.source_id == source_id)
+        columns = ['subject', 'source_id', 'created_at']
+        q = Tombstone.__table__.insert().from_select(columns, q)
+        self.config.engine.execute(q)
+        for table in [self.config.types, self.config.properties]:
+            table.delete(source_id=source_id)
+        self.cache.clear()
+
+    def _right_clause(self, table, right, bind=False):
+        """ Generate a condition which matches the statements visible with
+        a particular right. If ``bind`` is set, the values of the right are
+        bound parameters, which are returned alongside the condition. """
+        cond, params = [], {}
+        if len(right.collections):
+            params['collections'] = list(right.collections)
+            value = params['collections']
+            if bind:
+                value = bindparam('collections', expanding=True)
+            cond.append(table.c.collection_id.in_(value))
+        if len(right.sources):
+            params['sources'] = list(right.sources)
+            value = params['sources']
+            if bind:
+                value = bindparam('sources', expanding=True)
+            cond.append(table.c.source_id.in_(value))
+        if right.author is not None:
+            author = self.config.terms.encode(right.author, create=False)
+            if author is not None:
+                params['author'] = author
+                value = bindparam('author') if bind else author
+                cond.append(table.c.author == value)
+        if not len(cond):
+            return false(), params
+        return or_(*cond), params
 
     def _filter_type_right(self, q, right):
         """ Extend a query to filter for types matching a particular right. """
         if right is None:
             return q
-        cols = self.config.types.table.columns
-        cond = []
-        if right.collections is not None:
-            cond.append(cols.collection_id.in_(right.collections))
-        if right.sources is not None:
-            cond.append(cols.source_id.in_(right.sources))
-        if right.author is not None:
-            cond.append(cols.author == right.author)
-        return q.where(or_(*cond))
+        cond, _ = self._right_clause(self.config.types.table, right)
+        return q.where(cond)
 
-    def get_schema(self, subject, right=None):
-        """ For a given entity subject, return the appropriate schema. If this
-        returns ``None``, the entity/subject does not exist. """
+    def _prepare(self, kind, right, batch=False):
+        """ Get a compiled query for the properties or the types of subjects,
+        filtered for the given right, and the parameters of the right. A
+        query is compiled once for each combination of right attributes. """
+        if kind == 'property':
+            table, make_query = self.config.properties.table, \
+                self._property_query
+        else:
+            table, make_query = self.config.types.table, self._schema_query
+        cond, params = None, {}
+        if right is not None:
+            cond, params = self._right_clause(table, right, bind=True)
+        shape = (kind, batch, right is not None, tuple(sorted(params)))
+        if shape not in self.queries:
+            q = make_query(batch=batch)
+            if cond is not None:
+                q = q.where(cond)
+            self.queries[shape] = q.compile(self.config.engine)
+        return self.queries[shape], params
+
+    def _schema_query(self, batch=False):
+        """ Generate a query for the type declarations of a subject, or of a
+        set of subjects, with the most recent first. """
         table = self.config.types.table
-        q = select([table.c.schema, table.c.collection_id, table.c.source_id,
-                    table.c.author])
-        q = q.where(table.c.subject == subject)
-        q = self._filter_type_right(q, right)
+        q = select([table.c.subject, table.c.schema, table.c.collection_id,
+                    table.c.source_id, table.c.author])
+        if batch:
+            subjects = bindparam('subjects', expanding=True)
+            q = q.where(table.c.subject.in_(subjects))
+        else:
+            q = q.where(table.c.subject == bindparam('subject'))
         order_by = table.c.created_at.desc()
         if self.config.is_postgresql:
             order_by = order_by.nullslast()
-        q = q.order_by(order_by)
-        rp = self.config.engine.execute(q)
-        for row in rp.fetchall():
-            if right is not None and not right.check(row):
-                continue
-            return row.schema
+        return q.order_by(order_by)
+
+    def get_schema(self, subject, right=None):
+        """ For a given entity subject, return the appropriate schema. If this
+        returns ``None``, the entity/subject does not exist. """
+        q, params = self._prepare('schema', right)
+        rp = self.config.engine.execute(q, subject=subject, **params)
+        row = rp.first()
+        if row is not None:
+            return self.config.terms.decode(row.schema)
+
+    def get_schemas(self, subjects, right=None):
+        """ Get the schemas of several subjects at once, as a dict. Subjects
+        which do not exist are not included. """
+        q, params = self._prepare('schema', right, batch=True)
+        subjects = list(subjects)
+        schemas = {}
+        for i in range(0, len(subjects), BATCH_SIZE):
+            batch = subjects[i:i + BATCH_SIZE]
+            rp = self.config.engine.execute(q, subjects=batch, **params)
+            for row in rp.fetchall():
+                if row.subject in schemas:
+                    continue
+                schemas[row.subject] = self.config.terms.decode(row.schema)
+        return schemas
 
     def get(self, subject, schema=None, depth=1, right=None):
         """ Get an object representation of an entity defined by the given
@@ -211,19 +410,21 @@ class EntityManager(object):
         if schema is None:
             return
         visitor = self.get_statements_visitor(schema)
-        loader = self.make_loader(right)
+        loader = self.make_batch_loader(right, [subject], depth=depth)
         return visitor.objectify(loader, subject, depth=depth)
 
-    def subjects(self, schema=None, source_id=None, collection_id=None,
-                 chunk=10000, right=None):
-        """ Iterate over all entity IDs which match the current set of
-        constraints (i.e. a specific schema or source dataset). """
+    def _subject_filter(self, q, schema=None, source_id=None,
+                        collection_id=None, right=None, shard=None,
+                        start=None, end=None):
+        """ Apply the constraints of a subject iteration to a query on the
+        types table. Returns ``None`` if no subjects can match. """
         table = self.config.types.table
-        q = select([table.c.subject, table.c.collection_id, table.c.source_id,
-                    table.c.author, table.c.schema])
         q = self._filter_type_right(q, right)
         if schema is not None:
-            q = q.where(table.c.schema == schema)
+            schema_id = self.config.terms.encode(schema, create=False)
+            if schema_id is None:
+                return
+            q = q.where(table.c.schema == schema_id)
         if source_id is not None:
             q = q.where(table.c.source_id == source_id)
         if collection_id is not None:
@@ -231,21 +432,159 @@ class EntityManager(object):
             join = table.join(cst, cst.c.subject == table.c.subject)
             q = q.select_from(join)
             q = q.where(cst.c.collection_id == collection_id)
-        q = q.order_by(table.c.subject)
+        if start is not None:
+            q = q.where(table.c.subject >= start)
+        if end is not None:
+            q = q.where(table.c.subject < end)
+        if shard is not None and self.config.is_postgresql:
+            index, count = shard
+            hashed = cast(func.hashtext(table.c.subject), BigInteger)
+            q = q.where(func.abs(hashed) % count == index)
+        return q
+
+    def _in_shard(self, subject, shard):
+        """ Check the hash shard of a subject on databases which cannot
+        compute it in SQL. """
+        if shard is None or self.config.is_postgresql:
+            return True
+        index, count = shard
+        return (crc32(subject.encode('utf-8')) & 0xffffffff) % count == index
+
+    def subjects(self, schema=None, source_id=None, collection_id=None,
+                 chunk=10000, right=None, after=None, shard=None, start=None,
+                 end=None):
+        """ Iterate over all entity IDs which match the current set of
+        constraints (i.e. a specific schema or source dataset), in order.
+
+        Subjects are fetched in pages of ``chunk``, so iteration can be
+        resumed from the last subject seen by passing it as ``after``. The
+        subjects can be split across workers either by range (``start``
+        inclusive, ``end`` exclusive), or by hash, with ``shard`` given as
+        a tuple of ``(index, count)``. The hash used differs between
+        database backends. """
+        for page in self._subject_pages(schema=schema, source_id=source_id,
+                                        collection_id=collection_id,
+                                        chunk=chunk, right=right, after=after,
+                                        shard=shard, start=start, end=end):
+            for item in page:
+                yield item
+
+    def _subject_pages(self, schema=None, source_id=None, collection_id=None,
+                       chunk=10000, right=None, after=None, shard=None,
+                       start=None, end=None):
+        """ Generate the results of ``subjects`` one page at a time. """
+        table = self.config.types.table
+        filters = dict(schema=schema, source_id=source_id,
+                       collection_id=collection_id, right=right, shard=shard,
+                       start=start, end=end)
+        pq = select([table.c.subject]).distinct()
+        pq = self._subject_filter(pq, **filters)
+        if pq is None:
+            return
+        pq = pq.order_by(table.c.subject).limit(chunk)
+        q = select([table.c.subject, table.c.collection_id, table.c.source_id,
+                    table.c.author, table.c.schema])
+        q = self._subject_filter(q, **filters)
         order_by = table.c.created_at.desc()
         if self.config.is_postgresql:
             order_by = order_by.nullslast()
-        q = q.order_by(order_by)
-        rp = self.config.engine.execute(q)
+        q = q.order_by(table.c.subject, order_by)
 
-        prev = None
         while True:
-            rows = rp.fetchmany(chunk)
-            if not len(rows):
+            page = pq
+            if after is not None:
+                page = page.where(table.c.subject > after)
+            subjects = [r.subject for r in
+                        self.config.engine.execute(page).fetchall()]
+            if not len(subjects):
                 return
-            for row in rows:
-                if right is not None and not right.check(row):
+            rq = q.where(table.c.subject >= subjects[0])
+            rq = rq.where(table.c.subject <= subjects[-1])
+            prev, page = None, []
+            for row in self.config.engine.execute(rq).fetchall():
+                if row.subject == prev:
                     continue
-                if row.subject != prev:
-                    yield (row.subject, row.schema)
-                    prev = row.subject
+                prev = row.subject
+                if self._in_shard(row.subject, shard):
+                    page.append((row.subject,
+                                 self.config.terms.decode(row.schema)))
+            yield page
+            after = subjects[-1]
+
+    def iterate(self, schema=None, source_id=None, chunk=1000, right=None,
+                depth=1, shard=None, start=None, end=None):
+        """ Generate the objects of all entities matching the constraints,
+        as ``(subject, schema, object)``. Pages of subjects are read from
+        the types table in one query each, and the statements of each page
+        are fetched in batches, level by level up to ``depth``, so that
+        building an object requires no query of its own. """
+        pages = self._subject_pages(schema=schema, source_id=source_id,
+                                    chunk=chunk, right=right, shard=shard,
+                                    start=start, end=end)
+        for page in pages:
+            if not len(page):
+                continue
+            subjects = [s for (s, _) in page]
+            loader = self.make_batch_loader(right, subjects, depth=depth)
+            for subject, subject_schema in page:
+                visitor = self.get_statements_visitor(subject_schema)
+                data = visitor.objectify(loader, subject, depth=depth)
+                yield subject, subject_schema, data
+
+    def last_change(self):
+        """ Get the creation time of the most recent statement or
+        removal. """
+        latest = None
+        for table in [self.config.types.table, self.config.properties.table,
+                      Tombstone.__table__]:
+            q = select([func.max(table.c.created_at)])
+            value = self.config.engine.execute(q).scalar()
+            if value is not None and (latest is None or value > latest):
+                latest = value
+        return latest
+
+    def changed_subjects(self, since, source_id=None):
+        """ Get the set of subjects which have type or property statements
+        created after the given time. """
+        subjects = set()
+        for table in [self.config.types.table, self.config.properties.table]:
+            q = select([table.c.subject]).distinct()
+            q = q.where(table.c.created_at > since)
+            if source_id is not None:
+                q = q.where(table.c.source_id == source_id)
+            rp = self.config.engine.execute(q)
+            while True:
+                rows = rp.fetchmany(10000)
+                if not len(rows):
+                    break
+                subjects.update([r.subject for r in rows])
+        return subjects
+
+    def removed_subjects(self, since, source_id=None):
+        """ Get the set of subjects which had statements removed after the
+        given time. """
+        table = Tombstone.__table__
+        q = select([table.c.subject]).distinct()
+        q = q.where(table.c.created_at > since)
+        if source_id is not None:
+            # Tombstones without a source cover all sources.
+            q = q.where(or_(table.c.source_id == source_id,
+                            table.c.source_id.is_(None)))
+        rp = self.config.engine.execute(q)
+        return set([r.subject for r in rp.fetchall()])
+
+    def linking_subjects(self, subjects, source_id=None):
+        """ Get the set of subjects which link to any of the given ones. """
+        table = self.config.properties.table
+        q = select([table.c.subject]).distinct()
+        q = q.where(table.c.type == TYPE_LINK)
+        q = q.where(table.c.object.in_(bindparam('objects', expanding=True)))
+        if source_id is not None:
+            q = q.where(table.c.source_id == source_id)
+        subjects = list(subjects)
+        linking = set()
+        for i in range(0, len(subjects), BATCH_SIZE):
+            batch = subjects[i:i + BATCH_SIZE]
+            rp = self.config.engine.execute(q, objects=batch)
+            linking.update([r.subject for r in rp.fetchall()])
+        return linking
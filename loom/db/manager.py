@@ -1,8 +1,13 @@
 import logging
+from time import time
+from multiprocessing.pool import ThreadPool
 
-from sqlalchemy import func
-from sqlalchemy.sql.expression import select
+from sqlalchemy import func, inspect
+from sqlalchemy.sql.expression import select, bindparam
 
+from loom.db import partition
+from loom.db.partition import is_partitioned, drop_partition
+from loom.db.util import statement_hash, hash_clause, upsert
 from loom.db.writer import Writer
 
 log = logging.getLogger(__name__)
@@ -18,25 +23,181 @@ class TableManager(object):
         self.bind = config.engine
         self.name = clazz.__tablename__
 
+    @property
+    def hash_columns(self):
+        """ The columns of the unique index on the statement hash. On a
+        partitioned table, this includes the partition key. """
+        if not hasattr(self, '_hash_columns'):
+            columns = ['hash']
+            if is_partitioned(self.bind, self.name):
+                columns.append('source_id')
+            self._hash_columns = columns
+        return self._hash_columns
+
     def writer(self):
         return Writer(self)
 
+    def encode(self, row):
+        """ Replace interned values (e.g. predicates) in a row with the IDs
+        of their terms. """
+        for column in self.cls.TERMS:
+            if column in row:
+                row[column] = self.config.terms.encode(row[column])
+        return row
+
+    def prepare(self, row):
+        """ Encode a row which is to be inserted, and add its statement hash
+        to skip duplicates. """
+        self.encode(row)
+        row['hash'] = statement_hash(row, self.cls.KEY)
+        return row
+
     def insert_many(self, rows, bind=None):
-        """ Insert a bunch of rows into the table. """
+        """ Insert a bunch of rows into the table. Rows which are already
+        present are marked as current again, rather than duplicated. """
+        rows = [self.prepare(row) for row in rows]
         conn = bind or self.bind.connect()
-        stmt = self.table.insert()
-        conn.execute(stmt, rows)
+        try:
+            conn.execute(upsert(self.table, self.bind, self.hash_columns),
+                         rows)
+        finally:
+            if bind is None:
+                conn.close()
 
     def delete(self, **kwargs):
+        filters = [k for (k, v) in kwargs.items() if v is not None]
+        if filters == ['source_id'] and is_partitioned(self.bind, self.name):
+            # Drop the whole partition rather than deleting row by row.
+            drop_partition(self.bind, self.name, kwargs['source_id'])
+            return
         q = self.table.delete()
         for column, value in kwargs.items():
-            if value is not None:
-                q = q.where(self.table.c[column] == value)
+            if value is None:
+                continue
+            if column in self.cls.TERMS:
+                value = self.config.terms.encode(value, create=False)
+                if value is None:
+                    return
+            q = q.where(self.table.c[column] == value)
         conn = self.bind.connect()
         tx = conn.begin()
         conn.execute(q)
         tx.commit()
 
+    @property
+    def hash_index(self):
+        """ The unique index on the statement hash. """
+        for index in self.table.indexes:
+            if index.unique and [c.name for c in index.columns] == ['hash']:
+                return index
+
+    def has_index(self, index):
+        indexes = inspect(self.bind).get_indexes(self.name)
+        return index.name in [i['name'] for i in indexes]
+
+    def _dedupe_unhashed(self, conn):
+        """ Hash rows in batches, deleting those which duplicate a row that
+        has been hashed before. """
+        table = self.table
+        columns = [table.c.id] + [table.c[c] for c in self.cls.KEY]
+        q = select(columns).where(table.c.hash.is_(None))
+        q = q.order_by(table.c.id).limit(1000)
+        hashes = bindparam('hashes', expanding=True)
+        existing = select([table.c.hash]).where(table.c.hash.in_(hashes))
+        u = table.update().where(table.c.id == bindparam('_id'))
+        u = u.values(hash=bindparam('_hash'))
+        ids = bindparam('ids', expanding=True)
+        d = table.delete().where(table.c.id.in_(ids))
+        while True:
+            rows = conn.execute(q).fetchall()
+            if not len(rows):
+                return
+            hashes = [statement_hash(dict(r), self.cls.KEY) for r in rows]
+            seen = set([r.hash for r in conn.execute(existing,
+                                                     hashes=hashes)])
+            updates, deletes = [], []
+            for row, hash_ in zip(rows, hashes):
+                if hash_ in seen:
+                    deletes.append(row.id)
+                else:
+                    seen.add(hash_)
+                    updates.append({'_id': row.id, '_hash': hash_})
+            with conn.begin():
+                if len(deletes):
+                    conn.execute(d, ids=deletes)
+                if len(updates):
+                    conn.execute(u, updates)
+
+    def dedupe(self, conn):
+        """ Hash and de-duplicate the rows which have no statement hash yet,
+        e.g. those created by earlier versions of loom. Rows which duplicate
+        a hashed statement are found using the unique index on the hash, so
+        other rows are left alone. If the index is missing (e.g. after a bulk
+        load), the duplicates among all hashed rows are removed first and the
+        index is created. """
+        index = self.hash_index
+        if index is not None and not self.has_index(index):
+            log.info("Removing duplicate statements from %r", self.name)
+            if self.config.is_postgresql:
+                q = """DELETE FROM %s a USING %s b
+                    WHERE a.hash = b.hash AND a.id > b.id"""
+            else:
+                q = """DELETE FROM %s WHERE hash IS NOT NULL AND id NOT IN (
+                    SELECT MIN(id) FROM %s WHERE hash IS NOT NULL
+                    GROUP BY hash)"""
+            conn.execute(q % (self.name, self.name))
+            self.create_index(index)
+        q = select([self.table.c.id]).where(self.table.c.hash.is_(None))
+        if conn.execute(q.limit(1)).first() is None:
+            return
+        log.info("Hashing statements in %r", self.name)
+        if not self.config.is_postgresql:
+            return self._dedupe_unhashed(conn)
+        args = {'table': self.name,
+                'a': hash_clause(self.cls.KEY, alias='a'),
+                'hash': hash_clause(self.cls.KEY)}
+        # Rows duplicating a statement which has a hash already:
+        q = """DELETE FROM %(table)s a WHERE a.hash IS NULL AND EXISTS (
+            SELECT 1 FROM %(table)s b WHERE b.hash = %(a)s)"""
+        conn.execute(q % args)
+        # Duplicates among the rows without a hash, keeping the newest:
+        q = """DELETE FROM %(table)s WHERE id IN (
+            SELECT id FROM (SELECT id, row_number() OVER (
+                PARTITION BY %(hash)s ORDER BY created_at DESC, id) AS n
+                FROM %(table)s WHERE hash IS NULL) d
+            WHERE d.n > 1)"""
+        conn.execute(q % args)
+        q = "UPDATE %(table)s SET hash = %(hash)s WHERE hash IS NULL"
+        conn.execute(q % args)
+
+    def drop_indexes(self):
+        """ Drop all secondary indexes of the table, e.g. to speed up a bulk
+        load. They can be re-created using ``create_indexes``. """
+        conn = self.bind.connect()
+        try:
+            for index in self.table.indexes:
+                log.info("Dropping index %r on %r", index.name, self.name)
+                conn.execute("DROP INDEX IF EXISTS %s" % index.name)
+        finally:
+            conn.close()
+
+    def create_index(self, index):
+        """ Create the given index of the table unless it already exists. """
+        if self.has_index(index):
+            return
+        begin = time()
+        log.info("Creating index %r on %r...", index.name, self.name)
+        conn = self.bind.connect()
+        try:
+            if is_partitioned(conn, self.name):
+                partition.create_index(conn, index)
+            else:
+                index.create(bind=conn)
+        finally:
+            conn.close()
+        log.info("Created index %r on %r in %.2fs", index.name, self.name,
+                 time() - begin)
+
     def __len__(self):
         q = select(columns=[func.count(True)], from_obj=self.table)
         rp = self.bind.connect().execute(q)
@@ -44,3 +205,29 @@ class TableManager(object):
 
     def __repr__(self):
         return "<TableManager(%r)>" % (self.name)
+
+
+def create_indexes(managers):
+    """ De-duplicate the given tables and (re-)create all their indexes. On
+    PostgreSQL, the indexes are built in parallel, each on a separate
+    connection. """
+    begin = time()
+    for manager in managers:
+        conn = manager.bind.connect()
+        try:
+            log.info("De-duplicating %r", manager.name)
+            manager.dedupe(conn)
+        finally:
+            conn.close()
+    indexes = [(m, i) for m in managers for i in m.table.indexes]
+    if len(indexes) and managers[0].config.is_postgresql:
+        pool = ThreadPool(processes=len(indexes))
+        try:
+            pool.map(lambda job: job[0].create_index(job[1]), indexes)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for (manager, index) in indexes:
+            manager.create_index(index)
+    log.info("Created %s indexes in %.2fs", len(indexes), time() - begin)
@@ -0,0 +1,97 @@
+import logging
+
+from sqlalchemy import inspect, Integer
+
+from loom.db.term import Term
+from loom.db.manager import create_indexes
+
+log = logging.getLogger(__name__)
+
+
+def _columns(bind, table):
+    return {c['name']: c['type'] for c in inspect(bind).get_columns(table)}
+
+
+def legacy_terms(manager):
+    """ Get the columns of a table which should reference interned terms, but
+    still hold their values (as in tables created by earlier versions of
+    loom). """
+    columns = _columns(manager.bind, manager.name)
+    return [c for c in manager.cls.TERMS
+            if c in columns and not isinstance(columns[c], Integer)]
+
+
+def is_outdated(manager):
+    """ Check if a statement table was created by an earlier version of loom
+    and needs to be upgraded before it can be used. """
+    if not manager.bind.has_table(manager.name):
+        return False
+    if 'hash' not in _columns(manager.bind, manager.name):
+        return True
+    return len(legacy_terms(manager)) > 0
+
+
+def drop_all_indexes(manager):
+    """ Drop all indexes which exist on the table, including those which are
+    no longer defined by the current version of loom. """
+    for index in inspect(manager.bind).get_indexes(manager.name):
+        log.info("Dropping index %r on %r", index['name'], manager.name)
+        manager.bind.execute("DROP INDEX IF EXISTS %s" % index['name'])
+
+
+def convert_terms(manager):
+    """ Replace the values in the term columns of a table with the IDs of
+    the interned terms. Returns ``True`` if the table had to be changed. """
+    columns = legacy_terms(manager)
+    if not len(columns):
+        return False
+    drop_all_indexes(manager)
+    term = Term.__tablename__
+    for column in columns:
+        log.info("Converting %r of %r to terms", column, manager.name)
+        args = {'table': manager.name, 'column': column, 'term': term}
+        q = """INSERT INTO %(term)s (value)
+            SELECT DISTINCT %(column)s FROM %(table)s
+            WHERE %(column)s IS NOT NULL
+            AND %(column)s NOT IN (SELECT value FROM %(term)s)"""
+        manager.bind.execute(q % args)
+        q = "ALTER TABLE %(table)s ADD COLUMN %(column)s_id INTEGER"
+        manager.bind.execute(q % args)
+        q = """UPDATE %(table)s SET %(column)s_id = (SELECT t.id
+            FROM %(term)s t WHERE t.value = %(table)s.%(column)s)"""
+        manager.bind.execute(q % args)
+        q = "ALTER TABLE %(table)s DROP COLUMN %(column)s"
+        manager.bind.execute(q % args)
+        q = "ALTER TABLE %(table)s RENAME COLUMN %(column)s_id TO %(column)s"
+        manager.bind.execute(q % args)
+    if 'hash' in _columns(manager.bind, manager.name):
+        # Any existing hashes were computed from the term values.
+        manager.bind.execute("UPDATE %s SET hash = NULL" % manager.name)
+    return True
+
+
+def add_hash_column(manager):
+    """ Add the statement hash column to a table created by an earlier
+    version of loom. Returns ``True`` if the table had to be changed. """
+    if 'hash' in _columns(manager.bind, manager.name):
+        return False
+    log.info("Adding statement hash to %r", manager.name)
+    # The indexes are re-built after the hashes have been computed.
+    drop_all_indexes(manager)
+    manager.bind.execute("ALTER TABLE %s ADD COLUMN hash VARCHAR(32)" %
+                         manager.name)
+    return True
+
+
+def upgrade(config):
+    """ Bring the statement tables of an existing database up to date with
+    the current version of loom. Term columns are converted to reference
+    interned terms, the statements are hashed and de-duplicated, and any
+    missing indexes (including the unique index on the statement hash, which
+    is needed to skip duplicates when loading) are created. """
+    Term.__table__.create(bind=config.engine, checkfirst=True)
+    managers = [config.types, config.properties]
+    for manager in managers:
+        convert_terms(manager)
+        add_hash_column(manager)
+    create_indexes(managers)
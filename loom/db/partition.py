@@ -0,0 +1,92 @@
+import six
+import logging
+
+from sqlalchemy.schema import CreateColumn
+
+log = logging.getLogger(__name__)
+
+# The statement tables which can be partitioned by source.
+PARTITIONED = ['entity', 'property']
+
+
+def partition_name(table, source_id):
+    return '%s_source_%s' % (table, int(source_id))
+
+
+def is_partitioned(bind, table):
+    """ Check if the given table has been created as a partitioned table. """
+    if bind.dialect.name != 'postgresql':
+        return False
+    q = """SELECT COUNT(*) FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.relname = %(table)s AND pg_table_is_visible(c.oid)"""
+    return bind.execute(q, table=table).scalar() > 0
+
+
+def create_index(bind, index, partitioned=True):
+    """ Create an index on a partitioned table. Unique indexes must include
+    the partition key, which does not change their meaning for statement
+    hashes since these include the source ID. """
+    columns = [c.name for c in index.columns]
+    if index.unique and 'source_id' not in columns:
+        columns.append('source_id')
+    q = "CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)" % \
+        ('UNIQUE ' if index.unique else '', index.name, index.table.name,
+         ', '.join(columns))
+    include = index.info.get('include')
+    if include:
+        q += ' INCLUDE (%s)' % ', '.join(include)
+    where = index.dialect_options['postgresql']['where']
+    if where is not None:
+        q += ' WHERE %s' % where
+    bind.execute(q)
+
+
+def create_partitioned(bind, table):
+    """ Create a statement table partitioned by source ID, with a default
+    partition for statements without a source. """
+    if bind.dialect.has_table(bind, table.name):
+        return
+    log.info("Creating table %r, partitioned by source", table.name)
+    columns = [six.text_type(CreateColumn(c).compile(dialect=bind.dialect))
+               for c in table.columns]
+    bind.execute("CREATE TABLE %s (%s) PARTITION BY LIST (source_id)" %
+                 (table.name, ', '.join(columns)))
+    bind.execute("CREATE TABLE %s_default PARTITION OF %s DEFAULT" %
+                 (table.name, table.name))
+    for index in table.indexes:
+        create_index(bind, index)
+
+
+def ensure_partitions(bind, source_id):
+    """ Create the partitions for the given source in each of the statement
+    tables which are partitioned. """
+    for table in PARTITIONED:
+        if not is_partitioned(bind, table):
+            continue
+        bind.execute("""CREATE TABLE IF NOT EXISTS %s PARTITION OF %s
+            FOR VALUES IN (%s)""" % (partition_name(table, source_id), table,
+                                     int(source_id)))
+
+
+def drop_partition(bind, table, source_id):
+    """ Remove all statements from a source by dropping its partition, and
+    create an empty replacement. If the source has no partition yet, its
+    statements (if any) are in the default partition, and are deleted from
+    there, since the new partition could not be created otherwise. """
+    name = partition_name(table, source_id)
+    log.info("Dropping partition %r of %r", name, table)
+    conn = bind.connect()
+    try:
+        with conn.begin():
+            if bind.dialect.has_table(conn, name):
+                conn.execute("ALTER TABLE %s DETACH PARTITION %s" %
+                             (table, name))
+                conn.execute("DROP TABLE %s" % name)
+            else:
+                conn.execute("DELETE FROM %s_default WHERE source_id = %s" %
+                             (table, int(source_id)))
+            conn.execute("CREATE TABLE %s PARTITION OF %s FOR VALUES IN (%s)"
+                         % (name, table, int(source_id)))
+    finally:
+        conn.close()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Index, DateTime, Integer, Unicode, func
+from sqlalchemy import Column, Index, DateTime, Integer, Unicode, func, text
 
 from loom.db.util import Base, BigIntegerType
 
@@ -7,19 +7,34 @@ class Property(Base):
     """ Main statement table. """
     __tablename__ = 'property'
     __table_args__ = (
-        Index('ix_property_subject', 'subject'),
-        Index('ix_property_source_id', 'source_id')
+        # Used to load the statements about a subject in order:
+        Index('ix_property_subject_created_at', 'subject', 'created_at'),
+        Index('ix_property_source_id', 'source_id'),
+        # Used to find statements changed since the last indexing run, and
+        # the subjects linking to a changed subject:
+        Index('ix_property_created_at', 'created_at'),
+        Index('ix_property_link_object', 'object',
+              postgresql_where=text("type = 'link'"),
+              sqlite_where=text("type = 'link'")),
+        Index('ix_property_hash', 'hash', unique=True)
     )
 
+    # The columns which identify a distinct statement:
+    KEY = ('subject', 'predicate', 'object', 'source_id', 'collection_id',
+           'author')
+    # Columns which reference interned terms, rather than holding values:
+    TERMS = ('predicate', 'author')
+
     id = Column(BigIntegerType, primary_key=True)
     subject = Column(Unicode(1024))
-    predicate = Column(Unicode(255))
+    predicate = Column(Integer)
     object = Column(Unicode())
     type = Column(Unicode(32))
     source_id = Column(Integer, nullable=True)
     collection_id = Column(Integer, nullable=True)
-    author = Column(Unicode(512), nullable=True)
+    author = Column(Integer, nullable=True)
     created_at = Column(DateTime, default=func.now(), nullable=True)
+    hash = Column(Unicode(32), nullable=True)
 
     def __repr__(self):
         return '<Property(%r,%r,%r)>' % (self.subject, self.predicate,
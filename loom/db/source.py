@@ -1,6 +1,7 @@
 from sqlalchemy import Column, Unicode
 
 from loom.db.util import Base, CommonColumnsMixin, session
+from loom.db.partition import ensure_partitions
 
 
 class Source(Base, CommonColumnsMixin):
@@ -27,6 +28,7 @@ class Source(Base, CommonColumnsMixin):
         source.url = data.get('url')
         session.add(source)
         session.commit()
+        ensure_partitions(session.get_bind(), source.id)
         return source
 
     def to_dict(self):
@@ -0,0 +1,76 @@
+from threading import Lock
+from sqlalchemy import Column, Integer, Unicode
+from sqlalchemy.sql.expression import select
+
+from loom.db.util import Base, insert_ignore
+
+
+class Term(Base):
+    """ An interned string, such as a predicate, schema URI or author. These
+    are referenced by their ID from the statement tables, rather than being
+    repeated in each row. """
+    __tablename__ = 'term'
+
+    id = Column(Integer, primary_key=True)
+    value = Column(Unicode(1024), unique=True)
+
+    def __repr__(self):
+        return '<Term(%r,%r)>' % (self.id, self.value)
+
+
+class TermManager(object):
+    """ Translate interned strings to their IDs and back again. All terms
+    which have been used are cached in memory. """
+
+    def __init__(self, config):
+        self.config = config
+        self.table = Term.__table__
+        self.ids = {}
+        self.values = {}
+        self.lock = Lock()
+
+    def _cache(self, id, value):
+        with self.lock:
+            self.ids[value] = id
+            self.values[id] = value
+
+    def _lookup(self, conn, value):
+        q = select([self.table.c.id]).where(self.table.c.value == value)
+        return conn.execute(q).scalar()
+
+    def encode(self, value, create=True):
+        """ Get the ID for the given term. If it does not exist yet, it is
+        created, unless ``create`` is false, in which case ``None`` is
+        returned. """
+        if value is None:
+            return None
+        id = self.ids.get(value)
+        if id is not None:
+            return id
+        conn = self.config.engine.connect()
+        try:
+            id = self._lookup(conn, value)
+            if id is None and create:
+                # Another process may be interning the same term at the same
+                # time, so the ID is looked up after the insert.
+                stmt = insert_ignore(self.table, self.config.engine)
+                conn.execute(stmt, {'value': value})
+                id = self._lookup(conn, value)
+        finally:
+            conn.close()
+        if id is not None:
+            self._cache(id, value)
+        return id
+
+    def decode(self, id):
+        """ Get the term string for the given ID. """
+        if id is None:
+            return None
+        value = self.values.get(id)
+        if value is not None:
+            return value
+        q = select([self.table.c.value]).where(self.table.c.id == id)
+        value = self.config.engine.execute(q).scalar()
+        if value is not None:
+            self._cache(id, value)
+        return value
@@ -0,0 +1,22 @@
+from sqlalchemy import Column, Index, Integer, Unicode, DateTime
+
+from loom.db.util import Base
+
+
+class Tombstone(Base):
+    """ A record of the statements about a subject having been removed, so
+    incremental indexing can remove or update its document without checking
+    the whole index against the database. """
+    __tablename__ = 'tombstone'
+    __table_args__ = (
+        Index('ix_tombstone_created_at', 'created_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    subject = Column(Unicode(1024))
+    source_id = Column(Integer, nullable=True)
+    # Set when removing, in the same time base as the statements.
+    created_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return '<Tombstone(%r,%r)>' % (self.subject, self.created_at)
@@ -1,8 +1,14 @@
-from sqlalchemy import BigInteger, Integer, Column, DateTime, func
+import six
+from hashlib import md5
+
+from sqlalchemy import BigInteger, Integer, Column, DateTime, func, or_
 from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm.session import sessionmaker
 from sqlalchemy.orm.scoping import scoped_session
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateIndex
 
 Base = declarative_base()
 BigIntegerType = BigInteger()
@@ -17,3 +23,78 @@ class CommonColumnsMixin():
     id = Column(Integer, primary_key=True)
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+# Separates the values which make up a statement hash.
+HASH_SEPARATOR = u'\x1f'
+
+
+def statement_hash(row, columns):
+    """ Generate a compact hash of the given columns of a statement, which
+    identifies duplicate statements. ``hash_clause`` must generate the same
+    value in SQL. """
+    values = []
+    for column in columns:
+        value = row.get(column)
+        values.append(u'' if value is None else six.text_type(value))
+    return six.text_type(md5(HASH_SEPARATOR.join(values).encode('utf-8'))
+                         .hexdigest())
+
+
+def hash_clause(columns, alias=None):
+    """ Generate a PostgreSQL expression which computes the same value as
+    ``statement_hash``, optionally from the columns of a table alias. """
+    if alias is not None:
+        columns = ['%s.%s' % (alias, c) for c in columns]
+    values = ["coalesce(%s::text, '')" % c for c in columns]
+    return "md5(concat_ws(chr(31), %s))" % ', '.join(values)
+
+
+def insert_ignore(table, bind):
+    """ Generate an insert statement which skips rows that would violate a
+    unique constraint of the table. """
+    dialect = bind.dialect.name
+    if dialect == 'postgresql':
+        return pg_insert(table).on_conflict_do_nothing()
+    stmt = table.insert()
+    if dialect == 'sqlite':
+        stmt = stmt.prefix_with('OR IGNORE')
+    return stmt
+
+
+def upsert(table, bind, conflict):
+    """ Generate an insert statement for statements. A row which has the
+    same values as an existing one (i.e. which would violate the unique index
+    on the ``conflict`` columns) instead moves the creation time of the
+    existing row forward, so that it becomes the current value again. """
+    dialect = bind.dialect.name
+    if dialect == 'postgresql':
+        stmt = pg_insert(table)
+        newer = or_(table.c.created_at.is_(None),
+                    table.c.created_at < stmt.excluded.created_at)
+        return stmt.on_conflict_do_update(index_elements=conflict,
+                                          set_={'created_at':
+                                                stmt.excluded.created_at},
+                                          where=newer)
+    stmt = table.insert()
+    if dialect == 'sqlite':
+        stmt = stmt.prefix_with('OR REPLACE')
+    return stmt
+
+
+@compiles(CreateIndex, 'postgresql')
+def create_covering_index(create, compiler, **kw):
+    """ Add the columns listed as ``include`` in the info of an index as
+    non-key columns of the index. Older versions of PostgreSQL (before 11)
+    do not support these, and get a plain index instead. """
+    sql = compiler.visit_create_index(create, **kw)
+    include = create.element.info.get('include')
+    version = compiler.dialect.server_version_info
+    if not include or version is None or version < (11,):
+        return sql
+    include = ' INCLUDE (%s)' % ', '.join(include)
+    # The clause must precede the predicate of a partial index.
+    if create.element.dialect_options['postgresql']['where'] is not None:
+        pos = sql.rfind(' WHERE ')
+        return sql[:pos] + include + sql[pos:]
+    return sql + include
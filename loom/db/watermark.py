@@ -0,0 +1,48 @@
+import six
+from datetime import datetime
+from sqlalchemy import Column, Integer, Unicode
+
+from loom.db.util import Base, CommonColumnsMixin, session
+
+
+class Watermark(Base, CommonColumnsMixin):
+    """ The highest value of a change-tracking column which has been
+    processed, used to resume incrementally. """
+    __tablename__ = 'watermark'
+
+    name = Column(Unicode(255))
+    source_id = Column(Integer, nullable=True)
+    value = Column(Unicode())
+
+    @classmethod
+    def by_name(cls, name, source_id=None):
+        q = session.query(cls).filter_by(name=name, source_id=source_id)
+        return q.first()
+
+    @classmethod
+    def get(cls, name, source_id=None):
+        """ Get the stored value for the given watermark, if any. """
+        watermark = cls.by_name(name, source_id=source_id)
+        if watermark is not None:
+            return watermark.value
+
+    @classmethod
+    def set(cls, name, value, source_id=None):
+        """ Store a new value for the given watermark. Dates are stored in a
+        format which compares correctly with their SQL representation. """
+        if isinstance(value, datetime):
+            value = value.strftime('%Y-%m-%d %H:%M:%S.%f')
+        elif value is not None:
+            value = six.text_type(value)
+        watermark = cls.by_name(name, source_id=source_id)
+        if watermark is None:
+            watermark = cls()
+            watermark.name = name
+            watermark.source_id = source_id
+        watermark.value = value
+        session.add(watermark)
+        session.commit()
+        return watermark
+
+    def __repr__(self):
+        return '<Watermark(%r,%r)>' % (self.name, self.value)
@@ -1,73 +1,302 @@
 import logging
+import struct
 import unicodecsv
-import tempfile
 from time import time
+from datetime import datetime
 
 from threading import Thread
-from Queue import Queue
+from Queue import Queue, Empty, Full
+from sqlalchemy import BigInteger, Integer, DateTime
+from sqlalchemy.types import Variant
 
 log = logging.getLogger(__name__)
 
-IGNORE = ['id', 'collection_id', 'author', 'created_at']
+IGNORE = ['id', 'collection_id', 'author']
+
+# Header and trailer of the PostgreSQL binary COPY format.
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+PGCOPY_EPOCH = datetime(2000, 1, 1)
+
+# Connection settings used for bulk loading into SQLite.
+SQLITE_BULK_PRAGMAS = [
+    ('synchronous', 'OFF'),
+    ('journal_mode', 'MEMORY'),
+    ('cache_size', '-65536')
+]
+
+
+def _encode_text(value):
+    return unicode(value).encode('utf-8')
+
+
+def _encode_timestamp(value):
+    delta = value - PGCOPY_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000
+    return struct.pack('!q', micros + delta.microseconds)
+
+
+def _binary_encoder(column):
+    """ Get a function which encodes values for the given column in the
+    PostgreSQL binary COPY format. """
+    type_ = column.type
+    if isinstance(type_, Variant):
+        type_ = type_.impl
+    if isinstance(type_, BigInteger):
+        return lambda v: struct.pack('!q', v)
+    if isinstance(type_, Integer):
+        return lambda v: struct.pack('!i', v)
+    if isinstance(type_, DateTime):
+        return _encode_timestamp
+    return _encode_text
+
+
+class CopyStream(object):
+    """ A file-like object which is written to by the thread generating rows,
+    and read from by a ``COPY`` running in the loader thread. Data is kept in
+    a small, bounded in-memory buffer rather than a temporary file. """
+
+    BLOCK_SIZE = 65536
+
+    def __init__(self, size=64):
+        self.queue = Queue(maxsize=size)
+        self.buffer = []
+        self.buffered = 0
+        self.error = None
+        self.done = False
+        self.rows = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.BLOCK_SIZE:
+            self._put(b''.join(self.buffer))
+            self.buffer, self.buffered = [], 0
+
+    def _put(self, block):
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(block, timeout=1)
+                return
+            except Full:
+                pass
+
+    def close(self):
+        """ Mark the end of the data, which ends the ``COPY``. """
+        if len(self.buffer):
+            self._put(b''.join(self.buffer))
+            self.buffer, self.buffered = [], 0
+        self._put(None)
+
+    def abort(self, error):
+        """ Stop accepting data because the ``COPY`` has failed. """
+        self.error = error
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+
+    def read(self, size=-1):
+        if self.done:
+            return b''
+        block = self.queue.get()
+        if block is None:
+            self.done = True
+            return b''
+        return block
 
 
 class Writer(object):
     """ Do chunked bulk writes to the database, against a particular table
-    manager. """
+    manager. On PostgreSQL, rows are streamed into a ``COPY`` which runs in a
+    background thread. On other databases, rows are inserted in batches, each
+    in one transaction on a re-used connection. """
 
     def __init__(self, manager):
         self.manager = manager
-        self.engine = manager.config.engine
+        self.config = manager.config
+        self.engine = self.config.engine
         self.fields = [unicode(c.name) for c in self.manager.table.columns]
         self.fields = [f for f in self.fields if f not in IGNORE]
+        self.chunk = int(self.config.get('copy_chunk') or 500000)
+        self.binary = self.config.get('copy_format') == 'binary'
+        self.merge = bool(self.config.get('copy_merge', True))
+        self.batch = int(self.config.get('insert_chunk') or 10000)
         self.rows = 0
-        self.create_file()
+        self.stream = None
+        self.error = None
+        self.buffer = []
+        self.conn = None
+        self.pragmas = {}
+
+        if self.config.is_postgresql:
+            columns = self.manager.table.columns
+            self.encoders = [_binary_encoder(columns[f]) for f in self.fields]
+            self.queue = Queue(maxsize=1)
+            self.thread = Thread(target=self.loader_thread)
+            self.thread.daemon = True
+            self.thread.start()
 
-        self.queue = Queue(maxsize=2)
-        self.thread = Thread(target=self.loader_thread)
-        self.thread.daemon = True
-        self.thread.start()
+    def create_stream(self):
+        self.stream = CopyStream()
+        if self.binary:
+            self.stream.write(PGCOPY_HEADER)
+        else:
+            self.writer = unicodecsv.DictWriter(self.stream,
+                                                fieldnames=self.fields)
+        self.queue.put(self.stream)
 
-    def create_file(self):
-        self.temp = tempfile.NamedTemporaryFile(suffix='.csv')
-        self.writer = unicodecsv.DictWriter(self.temp, fieldnames=self.fields)
+    def close_stream(self):
+        if self.stream is None:
+            return
+        if self.binary:
+            self.stream.write(PGCOPY_TRAILER)
+        self.stream.close()
+        self.stream = None
 
     def loader_thread(self):
         while True:
-            rows, temp = self.queue.get()
-            self.bulk_load(rows, temp)
-            self.queue.task_done()
+            stream = self.queue.get()
+            try:
+                self.bulk_load(stream)
+            except Exception as ex:
+                log.exception(ex)
+                self.error = ex
+                stream.abort(ex)
+            finally:
+                self.queue.task_done()
 
-    def bulk_load(self, rows, temp):
-        temp.flush()
-        temp.seek(0)
+    def merge_query(self, stage):
+        """ Generate a query which inserts all rows from the staging table
+        which are not yet present in the target table, as identified by the
+        unique statement hash. Rows which are present already are marked as
+        current again by updating their creation time. """
+        fields = ', '.join(self.fields)
+        return """
+            INSERT INTO %(table)s (%(fields)s)
+                SELECT DISTINCT ON (hash) %(fields)s FROM %(stage)s
+                ORDER BY hash, created_at DESC
+                ON CONFLICT (%(conflict)s) DO UPDATE
+                SET created_at = excluded.created_at
+                WHERE %(table)s.created_at IS NULL
+                OR %(table)s.created_at < excluded.created_at
+        """ % {'table': self.manager.name, 'fields': fields, 'stage': stage,
+               'conflict': ', '.join(self.manager.hash_columns)}
+
+    def bulk_load(self, stream):
         begin = time()
         raw_conn = self.engine.raw_connection()
-        log.info("Bulk loading into %r (ca. %s)", self.manager.name, rows)
-        cur = raw_conn.cursor()
-        q = """
-            COPY %s (%s) FROM STDIN
-                WITH CSV HEADER DELIMITER ',' QUOTE '\"'
-                ENCODING 'utf-8'
-        """ % (self.manager.name, ', '.join(self.fields))
-        cur.copy_expert(q, temp)
-        raw_conn.commit()
-        cur.close()
+        log.info("Bulk loading into %r", self.manager.name)
+        try:
+            cur = raw_conn.cursor()
+            table = self.manager.name
+            if self.merge:
+                # Temporary tables are not written to the WAL, and are only
+                # visible to this session, so parallel loads can't clash.
+                table = '%s_stage' % self.manager.name
+                cur.execute("""
+                    CREATE TEMPORARY TABLE %s ON COMMIT DROP AS
+                        SELECT %s FROM %s WITH NO DATA
+                """ % (table, ', '.join(self.fields), self.manager.name))
+            if self.binary:
+                fmt = "BINARY"
+            else:
+                fmt = "CSV DELIMITER ',' QUOTE '\"' ENCODING 'utf-8'"
+            q = "COPY %s (%s) FROM STDIN WITH %s" % \
+                (table, ', '.join(self.fields), fmt)
+            cur.copy_expert(q, stream)
+            if self.merge:
+                cur.execute(self.merge_query(table))
+                log.info("Merged %s new rows into %r", cur.rowcount,
+                         self.manager.name)
+            raw_conn.commit()
+            cur.close()
+        finally:
+            raw_conn.close()
         duration = (time() - begin)
-        log.info("COPY done after %.2fs", duration)
-        temp.close()
+        log.info("COPY of %s rows into %r done after %.2fs", stream.rows,
+                 self.manager.name, duration)
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def connect(self):
+        """ Open the connection used for batched inserts. On SQLite, this
+        can apply settings that speed up bulk loading, at the cost of
+        durability if the process crashes during the load. """
+        self.conn = self.engine.connect()
+        if self.engine.dialect.name == 'sqlite' and \
+                self.config.get('sqlite_bulk_pragmas'):
+            for pragma, value in SQLITE_BULK_PRAGMAS:
+                q = 'PRAGMA %s' % pragma
+                self.pragmas[pragma] = self.conn.execute(q).scalar()
+                self.conn.execute('PRAGMA %s = %s' % (pragma, value))
+
+    def disconnect(self):
+        if self.conn is None:
+            return
+        for pragma, value in self.pragmas.items():
+            self.conn.execute('PRAGMA %s = %s' % (pragma, value))
+        self.pragmas = {}
+        self.conn.close()
+        self.conn = None
+
+    def insert_batch(self):
+        """ Insert all buffered rows in a single transaction. """
+        if not len(self.buffer):
+            return
+        if self.conn is None:
+            self.connect()
+        with self.conn.begin():
+            self.manager.insert_many(self.buffer, bind=self.conn)
+        self.buffer = []
 
     def flush(self):
-        if self.manager.config.is_postgresql:
-            self.queue.put((int(self.rows), self.temp))
+        if self.config.is_postgresql:
+            self.close_stream()
             self.queue.join()
+            self._check()
+        else:
+            try:
+                self.insert_batch()
+            finally:
+                self.disconnect()
+
+    def _write_binary(self, record):
+        values = [record.get(f) for f in self.fields]
+        data = [struct.pack('!h', len(values))]
+        for value, encode in zip(values, self.encoders):
+            if value is None:
+                data.append(struct.pack('!i', -1))
+            else:
+                value = encode(value)
+                data.append(struct.pack('!i', len(value)))
+                data.append(value)
+        self.stream.write(b''.join(data))
 
     def write(self, record):
         self.rows += 1
-        if self.manager.config.is_postgresql:
-            self.writer.writerow(record)
-            if self.rows > 0 and self.rows % 500000 == 0:
-                self.queue.put((int(self.rows), self.temp))
-                self.create_file()
+        # Set here rather than by the column default, which does not apply
+        # to rows loaded using COPY. Incremental indexing relies on it.
+        if record.get('created_at') is None:
+            record['created_at'] = datetime.utcnow()
+        if self.config.is_postgresql:
+            self._check()
+            self.manager.prepare(record)
+            if self.stream is None:
+                self.create_stream()
+            if self.binary:
+                self._write_binary(record)
+            else:
+                self.writer.writerow(record)
+            self.stream.rows += 1
+            if self.rows % self.chunk == 0:
+                self.close_stream()
         else:
-            self.manager.insert_many([record])
+            self.buffer.append(record)
+            if len(self.buffer) >= self.batch:
+                self.insert_batch()
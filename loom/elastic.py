@@ -37,6 +37,13 @@ BASE_SETTINGS = {
     }
 }
 
+# Used while bulk loading a new index. Replicas are created and the index
+# is refreshed once loading is done.
+LOAD_SETTINGS = {
+    "number_of_replicas": 0,
+    "refresh_interval": "-1"
+}
+
 
 def generate_mapping(schema, resolver):
     """ Generate a mapping. """
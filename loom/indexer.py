@@ -1,60 +1,117 @@
 import logging
 from time import time
-# from datetime import datetime
+from Queue import Empty
+from multiprocessing import Pool, Queue
+from datetime import datetime, timedelta
 from pprint import pprint  # noqa
 
 from elasticsearch.helpers import bulk, scan
 
-from loom.db import Source, session
+from loom.db import Source, Watermark, session
+from loom.config import Config
+from loom.util import LoomException
+from loom import analysis
 from loom.analysis import extract_text, latinize
-from loom.elastic import generate_mapping, BASE_SETTINGS
+from loom.elastic import generate_mapping, BASE_SETTINGS, LOAD_SETTINGS
 
 log = logging.getLogger(__name__)
 
+# Progress messages sent from the worker processes to the parent.
+_progress = None
+
+
+def _init_worker(queue):
+    global _progress
+    _progress = queue
+
+
+def _index_shard(args):
+    """ Index one hash shard of the subjects of a schema inside a worker
+    process, with its own database connections and bulk stream. """
+    config_data, config_path, target, schema, source_id, shard = args
+    config = Config(config_data, path=config_path)
+    config.setup()
+    indexer = Indexer(config)
+    indexer.target = target
+
+    def progress(count):
+        _progress.put((shard[0], count))
+
+    begin = time()
+    docs = indexer.generate_entities(schema, source_id, shard=shard,
+                                     progress=progress)
+    count, _ = bulk(config.elastic_client, docs, stats_only=True,
+                    chunk_size=indexer.chunk, request_timeout=60.0)
+    indexer.log_caches()
+    return {'shard': shard[0], 'docs': count, 'duration': time() - begin}
+
 
 class Indexer(object):
     """ Index JSON/RDF to ElasticSearch. """
 
-    def __init__(self, config):
+    def __init__(self, config, workers=1):
         self.config = config
         self.chunk = int(config.get('chunk') or 1000)
+        self.workers = max(1, int(workers or 1))
+        size = config.get('latin_cache')
+        if size is not None and int(size) != analysis.latin_cache.size:
+            analysis.configure_cache(int(size))
+        # A new index which is being built, instead of the configured one.
+        self.target = None
+
+    @property
+    def index_name(self):
+        return self.target or self.config.elastic_index
 
-    def configure(self):
+    def configure(self, index=None, loading=False):
+        """ Create the search index with the document mappings. If the index
+        is about to be bulk loaded, replicas and refreshes are disabled. """
         client = self.config.elastic_client
-        index = self.config.elastic_index
+        index = index or self.config.elastic_index
         log.info("Ensuring search index and document mappings...")
         mappings = {}
         for schema in self.config.schemas.values():
             doc_type = self.config.get_alias(schema)
             mapping = generate_mapping(schema, self.config.resolver)
             mappings[doc_type] = mapping
-        body = {'mappings': mappings, 'settings': BASE_SETTINGS}
+        settings = dict(BASE_SETTINGS)
+        if loading:
+            settings.update(LOAD_SETTINGS)
+        body = {'mappings': mappings, 'settings': settings}
         client.indices.create(ignore=400, index=index, body=body)
 
     def convert_entity(self, subject, schema=None, depth=1):
         entity = self.config.entities.get(subject, schema=schema, depth=depth)
-        # extend the object to index form
+        return self.make_document(entity, schema)
+
+    def make_document(self, entity, schema):
+        """ Extend an entity object to the form in which it is indexed. """
         entity['$text'] = extract_text(entity)
         entity['$latin'] = [latinize(t) for t in entity['$text']]
         entity['$suggest'] = entity.get('name')
+        entity['$indexed_at'] = datetime.utcnow().isoformat()
         # pprint(entity)
         return {
             '_id': entity.get('id'),
             '_type': self.config.get_alias(schema),
-            '_index': self.config.elastic_index,
+            '_index': self.index_name,
             '_source': entity
         }
 
-    def generate_entities(self, schema, source_id):
+    def generate_entities(self, schema, source_id, shard=None,
+                          progress=None):
         begin = time()
-        entities = self.config.entities.subjects(schema, source_id=source_id)
-        for i, (subject, schema) in enumerate(entities):
-            yield self.convert_entity(subject, schema=schema)
+        entities = self.config.entities.iterate(schema, source_id=source_id,
+                                                shard=shard, chunk=self.chunk)
+        for i, (subject, schema, entity) in enumerate(entities):
+            yield self.make_document(entity, schema)
             if i > 0 and i % 1000 == 0:
                 elapsed = time() - begin
                 per_rec = (elapsed / float(i)) * 1000
-                log.info("Indexing %r: %s records (%.2fms/r)",
-                         schema, i, per_rec)
+                log.info("Indexing %r: %s records (%.2fms/r, %.1f docs/s)",
+                         schema, i, per_rec, i / elapsed)
+                if progress is not None:
+                    progress(i)
 
     def is_schema_indexed(self, schema):
         if schema is None:
@@ -67,7 +124,8 @@ class Indexer(object):
             return False
         return True
 
-    def clear(self, schema=None, source_id=None):
+    def _scan(self, schema=None, source_id=None):
+        """ Iterate over the indexed documents matching the criteria. """
         filter_ = {'bool': {'must': []}}
         if schema is not None:
             filter_['bool']['must'].append({
@@ -79,24 +137,146 @@ class Indexer(object):
             })
         q = {'filtered': {'query': {'match_all': {}}, 'filter': filter_}}
         q = {'query': q, 'fields': []}
+        return scan(self.config.elastic_client, query=q,
+                    index=self.index_name)
 
+    def _delete(self, doc):
+        return {
+            '_op_type': 'delete',
+            '_index': self.index_name,
+            '_type': doc.get('_type'),
+            '_id': doc.get('_id')
+        }
+
+    def clear(self, schema=None, source_id=None):
         log.info('Deleting existing entries matching index criteria')
 
         def gen_deletes():
-            for res in scan(self.config.elastic_client, query=q,
-                            index=self.config.elastic_index):
-                yield {
-                    '_op_type': 'delete',
-                    '_index': self.config.elastic_index,
-                    '_type': res.get('_type'),
-                    '_id': res.get('_id')
-                }
+            for res in self._scan(schema=schema, source_id=source_id):
+                yield self._delete(res)
 
         bulk(self.config.elastic_client, gen_deletes(),
              stats_only=True, chunk_size=self.chunk,
              request_timeout=60.0)
 
-    def index(self, schema=None, source=None):
+    def _watermark_name(self, schema=None):
+        name = 'index:%s' % self.config.elastic_index
+        if schema is not None:
+            name = '%s:%s' % (name, self.config.get_alias(schema))
+        return name
+
+    def get_since(self, schema=None, source_id=None):
+        """ Get the creation time of the latest statement which had been
+        indexed by the last run with the same criteria. Statements are
+        stamped when they are written, but may be committed some time later,
+        so ``index_watermark_margin`` seconds are subtracted from it. """
+        since = Watermark.get(self._watermark_name(schema),
+                              source_id=source_id)
+        if since is not None:
+            since = datetime.strptime(since, '%Y-%m-%d %H:%M:%S.%f')
+            margin = self.config.get('index_watermark_margin', 900)
+            return since - timedelta(seconds=int(margin))
+
+    def generate_changes(self, since, schema=None, source_id=None,
+                         removed=None):
+        """ Generate index operations for the subjects which have changed
+        since the given time, those which had statements removed, and the
+        subjects linking to any of them. Subjects which do not match the
+        criteria are skipped. """
+        entities = self.config.entities
+        changed = entities.changed_subjects(since, source_id=source_id)
+        changed.update(removed or [])
+        changed.update(entities.linking_subjects(changed,
+                                                 source_id=source_id))
+        log.info("Re-indexing %s changed subjects", len(changed))
+        schemas = entities.get_schemas(changed)
+        implied = None
+        if schema is not None:
+            implied = self.config.implied_schemas(schema)
+        for subject in changed:
+            subject_schema = schemas.get(subject)
+            if implied is not None and subject_schema not in implied:
+                continue
+            if not self.is_schema_indexed(subject_schema):
+                continue
+            yield self.convert_entity(subject, schema=subject_schema)
+
+    def generate_deletes(self, subjects):
+        """ Generate deletions for the indexed documents of the given
+        subjects, whatever their document type. """
+        subjects = list(subjects)
+        for i in range(0, len(subjects), self.chunk):
+            batch = subjects[i:i + self.chunk]
+            q = {'query': {'ids': {'values': batch}}, 'fields': []}
+            for doc in scan(self.config.elastic_client, query=q,
+                            index=self.index_name):
+                yield self._delete(doc)
+
+    def index_changes(self, since, schema=None, source_id=None):
+        """ Only re-index the subjects which changed since the given time,
+        and remove the subjects deleted since then from the index. Deleted
+        subjects are found using the tombstones left when removing them. """
+        client = self.config.elastic_client
+        entities = self.config.entities
+        log.info("Indexing changes since: %s", since)
+        removed = entities.removed_subjects(since, source_id=source_id)
+        bulk(client, self.generate_changes(since, schema=schema,
+                                           source_id=source_id,
+                                           removed=removed),
+             stats_only=True, chunk_size=self.chunk, request_timeout=60.0)
+        existing = entities.get_schemas(removed)
+        deleted = [s for s in removed if s not in existing]
+        deleted, _ = bulk(client, self.generate_deletes(deleted),
+                          stats_only=True, chunk_size=self.chunk,
+                          request_timeout=60.0)
+        log.info("Removed %s deleted subjects from the index", deleted)
+
+    def index_parallel(self, schema, source_id):
+        """ Index the entities of a schema in several worker processes, each
+        of which handles a hash shard of the subjects. """
+        begin = time()
+        tasks = [(self.config.data, self.config.path, self.target, schema,
+                  source_id, (i, self.workers)) for i in range(self.workers)]
+        # Forked workers must not share database connections.
+        self.config.engine.dispose()
+        queue = Queue()
+        pool = Pool(processes=self.workers, initializer=_init_worker,
+                    initargs=(queue,))
+        counts, last = {}, time()
+        try:
+            result = pool.map_async(_index_shard, tasks)
+            while not result.ready():
+                try:
+                    shard, count = queue.get(timeout=1)
+                    counts[shard] = count
+                except Empty:
+                    pass
+                if time() - last > 10 and len(counts):
+                    last = time()
+                    total = sum(counts.values())
+                    log.info("Indexing %r: %s records in %s workers "
+                             "(%.1f docs/s)", schema, total, self.workers,
+                             total / (last - begin))
+            results = result.get()
+        finally:
+            pool.terminate()
+            pool.join()
+        for res in sorted(results, key=lambda r: r['shard']):
+            speed = res['docs'] / res['duration'] if res['duration'] else 0
+            log.info("Indexed %r shard %s: %s docs (%.1f docs/s)", schema,
+                     res['shard'], res['docs'], speed)
+        total = sum([r['docs'] for r in results])
+        log.info("Indexed %r: %s docs in %.2fs", schema, total,
+                 time() - begin)
+
+    def index(self, schema=None, source=None, incremental=False,
+              rebuild=False):
+        """ Index all entities matching the criteria. In incremental mode,
+        only the entities which changed since the last run are indexed. When
+        re-building, all entities are indexed into a new index, which then
+        replaces the current one. """
+        if rebuild and (schema is not None or source is not None):
+            raise LoomException("A re-build always covers all entities.")
         if source is not None:
             q = session.query(Source.id).filter_by(slug=source)
             obj = q.first()
@@ -106,15 +286,115 @@ class Indexer(object):
         client = self.config.elastic_client
         log.debug('Indexing to: %r (index: %r)', client,
                   self.config.elastic_index)
-        self.clear(schema=schema, source_id=source)
+        # Statements created while indexing are picked up by the next run.
+        latest = self.config.entities.last_change()
+        since = None
+        if incremental:
+            since = self.get_since(schema=schema, source_id=source)
+        if rebuild:
+            self.rebuild()
+        elif since is not None:
+            self.index_changes(since, schema=schema, source_id=source)
+        else:
+            self.index_all(schema=schema, source_id=source)
+        client.indices.flush_synced()
+        if latest is not None:
+            Watermark.set(self._watermark_name(schema), latest,
+                          source_id=source)
+        self.log_caches()
+
+    def log_caches(self):
+        """ Log the hit rates of the caches used while indexing. """
+        caches = [('Statement', self.config.entities.cache),
+                  ('Transliteration', analysis.latin_cache)]
+        for name, cache in caches:
+            if cache.size > 0:
+                log.info("%s cache: %s hits, %s misses (%.1f%%)", name,
+                         cache.hits, cache.misses, cache.hit_rate * 100)
+
+    def index_all(self, schema=None, source_id=None):
+        """ Clear the index and re-index all entities. """
+        self.clear(schema=schema, source_id=source_id)
+        self.index_schemas(schema=schema, source_id=source_id)
+
+    def index_schemas(self, schema=None, source_id=None):
+        client = self.config.elastic_client
         schemas = self.config.schemas.values() if schema is None else [schema]
         for schema in schemas:
             if not self.is_schema_indexed(schema):
                 continue
-            bulk(client, self.generate_entities(schema, source),
+            if self.workers > 1:
+                self.index_parallel(schema, source_id)
+                continue
+            bulk(client, self.generate_entities(schema, source_id),
                  stats_only=True, chunk_size=self.chunk,
                  request_timeout=60.0)
-        client.indices.flush_synced()
+
+    def rebuild(self):
+        """ Index all entities into a new, versioned index. Once it is
+        complete, the configured index name is pointed to it as an alias,
+        and the previous index is deleted. Searches use the old index until
+        then, so they are not affected by the re-build. """
+        client = self.config.elastic_client
+        alias = self.config.elastic_index
+        stamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        self.target = '%s-%s' % (alias, stamp)
+        log.info("Re-building search index: %r", self.target)
+        settings = self.serving_settings(alias)
+        self.configure(index=self.target, loading=True)
+        try:
+            self.index_schemas()
+            client.indices.put_settings(index=self.target,
+                                        body={'index': settings})
+            client.indices.refresh(index=self.target)
+            self.swap_alias(alias, self.target)
+        except Exception:
+            client.indices.delete(index=self.target, ignore=404)
+            raise
+        finally:
+            self.target = None
+
+    def serving_settings(self, alias):
+        """ Get the replica and refresh settings to apply to a re-built
+        index once it is loaded. Configured values take precedence over
+        those of the index which is currently in use. """
+        client = self.config.elastic_client
+        settings = {'number_of_replicas': 1, 'refresh_interval': '1s'}
+        if client.indices.exists(index=alias):
+            current = client.indices.get_settings(index=alias)
+            for data in current.values():
+                index = data.get('settings', {}).get('index', {})
+                for key in settings.keys():
+                    if index.get(key) is not None:
+                        settings[key] = index.get(key)
+        replicas = self.config.get('elastic_replicas')
+        if replicas is not None:
+            settings['number_of_replicas'] = int(replicas)
+        refresh = self.config.get('elastic_refresh_interval')
+        if refresh is not None:
+            settings['refresh_interval'] = refresh
+        return settings
+
+    def swap_alias(self, alias, index):
+        """ Atomically point the alias to the given index, and delete the
+        indexes it pointed to before. """
+        client = self.config.elastic_client
+        previous = []
+        if client.indices.exists_alias(name=alias):
+            previous = client.indices.get_alias(name=alias).keys()
+        elif client.indices.exists(index=alias):
+            # An alias cannot replace an index of the same name, so an index
+            # created before re-builds were used has to go first.
+            log.warning("Deleting index %r to replace it by an alias", alias)
+            client.indices.delete(index=alias)
+        actions = [{'remove': {'index': p, 'alias': alias}} for p in previous]
+        actions.append({'add': {'index': index, 'alias': alias}})
+        client.indices.update_aliases(body={'actions': actions})
+        log.info("Search index %r now points to %r", alias, index)
+        for name in previous:
+            if name != index:
+                log.info("Deleting previous search index: %r", name)
+                client.indices.delete(index=name)
 
     def index_one(self, subject, schema=None, depth=1):
         if schema is None:
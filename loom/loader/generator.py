@@ -1,6 +1,8 @@
 import logging
 from collections import Mapping
 
+from sqlalchemy import func, type_coerce, Unicode
+from sqlalchemy.dialects.postgresql import array
 from sqlalchemy.schema import Table, MetaData
 from sqlalchemy.sql.expression import select
 
@@ -64,6 +66,11 @@ class Generator(object):
             raise SpecException("Invalid column: %s" % name)
         return table.columns[name]
 
+    def label(self, column):
+        """ Get the name under which a column is included in the generated
+        records. """
+        return '%s.%s' % (column.table.name, column.name)
+
     def _scan_columns(self, obj):
         """ Find out which columns are accessed by a particular output
         mapping. """
@@ -81,33 +88,155 @@ class Generator(object):
                 columns.extend(self._scan_columns(o))
         return set(columns)
 
-    def _query(self, tables, columns):
-        """ Generate a query and iterate over the result cursor. This will
-        automatically apply any necessary joins. """
+    @property
+    def chunk(self):
+        return int(self.spec.get('chunk') or 10000)
+
+    def _select(self, tables, columns):
+        """ Generate a query for the given columns. This will automatically
+        apply any necessary joins. """
         q = select(columns=columns, from_obj=tables)
         for (left, right) in self.joins:
             if left.table in tables and right.table in tables:
                 q = q.where(left == right)
+        return q
 
+    def _query(self, q, key=None):
+        """ Iterate over the result cursor of the given query. """
         log.debug("Query: %s", q)
-        # TODO: see if this scales (i.e. the cursor loads data progressively)
-        # else introduce pagination and sorting.
-        rp = self.spec.engine.execute(q)
+        if self.spec.is_postgresql:
+            return self._stream(q)
+        if key is not None:
+            return self._paginate(q, key)
+        return self._stream(q)
+
+    def _stream(self, q):
+        """ Iterate over the results of a query. On PostgreSQL, this will use
+        a named, server-side cursor so that the result set is not buffered in
+        memory on the client. """
+        conn = self.spec.engine.connect()
+        try:
+            conn = conn.execution_options(stream_results=True)
+            rp = conn.execute(q)
+            while True:
+                rows = rp.fetchmany(self.chunk)
+                if not len(rows):
+                    break
+                for row in rows:
+                    yield dict(row.items())
+        finally:
+            conn.close()
+
+    def _paginate(self, q, key):
+        """ Iterate over the results of a query using keyset pagination, i.e.
+        by sorting on the key column and fetching one page at a time. The key
+        must be unique for each record generated by the query. """
+        label = self.label(key)
+        q = q.order_by(key.asc()).limit(self.chunk)
+        last = None
         while True:
-            rows = rp.fetchmany(10000)
-            if not len(rows):
-                break
+            pq = q
+            if last is not None:
+                pq = pq.where(key > last)
+            rows = self.spec.engine.execute(pq).fetchall()
             for row in rows:
                 yield dict(row.items())
-
-    def generate(self, mapping_name):
-        """ Generate all the items produced by the given mapping. """
-        mapping = self.spec.get_mapping(mapping_name)
+            if len(rows) < self.chunk:
+                break
+            last = rows[-1][label]
+
+    def get_key(self, mapping):
+        """ Get the column used to sort and paginate the records of a mapping,
+        if one is configured in the spec. """
+        key = mapping.get('key')
+        if key is not None:
+            return self.get_column(key)
+
+    def get_incremental(self, mapping):
+        """ Get the change-tracking column of a mapping (e.g. a modification
+        date or a sequential ID), if one is configured in the spec. """
+        column = mapping.get('incremental')
+        if column is not None:
+            return self.get_column(column)
+
+    def _mapping_query(self, mapping, since=None):
+        """ Generate the query for a mapping, with each column labelled as it
+        is referenced in the spec. If ``since`` is given, only records with a
+        change-tracking value greater than it are selected. """
         columns = set(self.get_column(c) for c in self._scan_columns(mapping))
+        key = self.get_key(mapping)
+        if key is not None:
+            columns.add(key)
+        incremental = self.get_incremental(mapping)
+        if incremental is not None:
+            columns.add(incremental)
         tables = set([c.table for c in columns])
-
-        _columns = []
-        for column in columns:
-            alias = '%s.%s' % (column.table.name, column.name)
-            _columns.append(column.label(alias))
-        return self._query(tables, _columns)
+        _columns = [c.label(self.label(c)) for c in columns]
+        q = self._select(tables, _columns)
+        if since is not None:
+            if incremental is None:
+                raise SpecException("Mapping has no incremental column.")
+            q = q.where(type_coerce(incremental, Unicode) > since)
+        return q, key
+
+    def partitions(self, mapping_name, count, since=None):
+        """ Split the records generated by a mapping into up to ``count`` key
+        ranges of roughly equal size. Each range is a tuple of ``(start, end)``
+        where ``start`` is inclusive and ``end`` is exclusive; ``None`` marks
+        an open end. """
+        mapping = self.spec.get_mapping(mapping_name)
+        key = self.get_key(mapping)
+        if key is None:
+            raise SpecException("Mapping %r has no key to partition on." %
+                                mapping_name)
+        q, _ = self._mapping_query(mapping, since=since)
+        q = q.alias('records')
+        col = q.columns[self.label(key)]
+        if self.spec.is_postgresql:
+            values = self._bounds_percentiles(q, col, count)
+        else:
+            values = self._bounds_offsets(q, col, count)
+        bounds = []
+        for bound in values:
+            if bound is not None and bound not in bounds:
+                bounds.append(bound)
+        starts = [None] + bounds
+        ends = bounds + [None]
+        return list(zip(starts, ends))
+
+    def _bounds_percentiles(self, q, col, count):
+        """ Compute all range bounds in a single pass over the records. """
+        fractions = [float(i) / count for i in range(1, count)]
+        if not len(fractions):
+            return []
+        pq = select([func.percentile_disc(array(fractions))
+                     .within_group(col.asc())], from_obj=q)
+        return self.spec.engine.execute(pq).scalar() or []
+
+    def _bounds_offsets(self, q, col, count):
+        """ Find the range bounds by counting the records, and then seeking
+        to each bound. """
+        total = self.spec.engine.execute(select([func.count()],
+                                                from_obj=q)).scalar()
+        bounds = []
+        for i in range(1, count):
+            bq = select([col]).order_by(col.asc()).limit(1)
+            bq = bq.offset((total * i) // count)
+            bounds.append(self.spec.engine.execute(bq).scalar())
+        return bounds
+
+    def generate(self, mapping_name, start=None, end=None, since=None):
+        """ Generate all the items produced by the given mapping, optionally
+        limited to a range of the mapping key and to records changed after
+        the ``since`` value of the incremental column. """
+        mapping = self.spec.get_mapping(mapping_name)
+        q, key = self._mapping_query(mapping, since=since)
+        if start is not None or end is not None:
+            if key is None:
+                raise SpecException("Mapping %r has no key to select a "
+                                    "range on." % mapping_name)
+            if start is not None:
+                q = q.where(key >= start)
+            if end is not None:
+                q = q.where(key < end)
+        return self._query(q, key=key)
@@ -1,46 +1,112 @@
 import time
 import logging
+from itertools import imap
+from multiprocessing import Pool
 
 from jsonmapping import Mapper as SchemaMapper
 from jsonmapping import TYPE_SCHEMA
 
+from loom.db import Watermark, create_indexes
+from loom.config import Config
+from loom.loader.spec import Spec
 from loom.loader.generator import Generator
+from loom.loader.pipeline import Pipeline, batched
 
 log = logging.getLogger(__name__)
 
 
+def _max(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+def _map_range(args):
+    """ Map a key range of a mapping inside a worker process. The config and
+    spec are re-created from their raw data, so that each worker opens its
+    own database connections. """
+    (config_data, config_path, spec_data, spec_path, source_id, mapping_name,
+     start, end, since) = args
+    config = Config(config_data, path=config_path)
+    config.setup()
+    spec = Spec(config, spec_data, path=spec_path)
+    spec._source_id = source_id
+    mapper = Mapper(config, spec)
+    return mapper.map_range(mapping_name, start=start, end=end, since=since)
+
+
 class Mapper(object):
     """ Map generated records to the data model. """
 
-    def __init__(self, config, spec):
+    def __init__(self, config, spec, workers=1, concurrency=1,
+                 incremental=True, bulk=False):
         self.config = config
         self.spec = spec
+        self.incremental = incremental
+        self.bulk = bulk
+        self.workers = max(1, int(workers or 1))
+        self.concurrency = max(1, int(concurrency or 1))
         self.generator = Generator(spec)
 
-    def records(self, mapping_name):
-        mapper = SchemaMapper(self.spec.get_mapping(mapping_name),
-                              self.config.resolver, scope=self.config.base_uri)
+    def records(self, mapping_name, start=None, end=None, since=None,
+                stats=None):
+        mapping = self.spec.get_mapping(mapping_name)
+        mapper = SchemaMapper(mapping, self.config.resolver,
+                              scope=self.config.base_uri)
         schema = mapper.visitor.schema.get('id')
+        incremental = self.generator.get_incremental(mapping)
+        if incremental is not None:
+            incremental = self.generator.label(incremental)
+        stats = stats if stats is not None else {}
+        stats['records'], stats['statements'] = 0, 0
+        stats['watermark'] = None
         begin = time.time()
-        stmts = 0
-        for i, row in enumerate(self.generator.generate(mapping_name)):
-            _, data = mapper.apply(row)
-            for stmt in self.config.entities.triplify(schema, data):
-                stmts += 1
-                yield stmt
 
-            if i > 0 and i % 10000 == 0:
-                elapsed = time.time() - begin
-                per_record = float(elapsed) / float(i)
-                speed = per_record * 1000
-                log.info("Generating %r: %s records (%s, %.2fms/r)",
-                         mapping_name, i, stmts, speed)
+        def convert(rows):
+            statements = []
+            for row in rows:
+                _, data = mapper.apply(row)
+                stats['records'] += 1
+                if incremental is not None:
+                    stats['watermark'] = _max(stats['watermark'],
+                                              row.get(incremental))
+                statements.extend(self.config.entities.triplify(schema, data))
 
-    def map_mapping(self, mapping):
-        """ Bulk load data to the appropriate tables. """
+                i = stats['records']
+                if i % 10000 == 0:
+                    elapsed = time.time() - begin
+                    per_record = float(elapsed) / float(i)
+                    speed = per_record * 1000
+                    log.info("Generating %r: %s records (%s, %.2fms/r)",
+                             mapping_name, i,
+                             stats['statements'] + len(statements), speed)
+            stats['statements'] += len(statements)
+            return statements
+
+        rows = self.generator.generate(mapping_name, start=start, end=end,
+                                       since=since)
+        batches = batched(rows, 1000)
+        if self.spec.get('pipeline'):
+            pipeline = Pipeline(mapping_name, [('map', convert)])
+            batches = pipeline.run(batches)
+        else:
+            batches = imap(convert, batches)
+        for statements in batches:
+            for stmt in statements:
+                yield stmt
+
+    def map_range(self, mapping, start=None, end=None, since=None):
+        """ Bulk load data to the appropriate tables, optionally only for a
+        range of the mapping key and for records changed after ``since``.
+        Returns statistics about the mapped data. """
+        begin = time.time()
+        stats = {'mapping': mapping, 'start': start, 'end': end}
         types = self.config.types.writer()
         properties = self.config.properties.writer()
-        for (s, p, o, t) in self.records(mapping):
+        for (s, p, o, t) in self.records(mapping, start=start, end=end,
+                                         since=since, stats=stats):
             if p == TYPE_SCHEMA:
                 types.write({
                     'subject': s,
@@ -57,7 +123,148 @@ class Mapper(object):
                 })
         properties.flush()
         types.flush()
+        stats['duration'] = time.time() - begin
+        return stats
+
+    def _log_stats(self, stats):
+        speed = 0.0
+        if stats['duration'] > 0:
+            speed = stats['records'] / stats['duration']
+        log.info("Mapped %r: %s records, %s statements in %.2fs (%.1f r/s)",
+                 stats['mapping'], stats['records'], stats['statements'],
+                 stats['duration'], speed)
+
+    def _watermark_name(self, mapping):
+        return 'mapping:%s' % mapping
+
+    def get_since(self, mapping):
+        """ Get the watermark up to which the given mapping has already been
+        mapped, if it is incremental. """
+        if not self.incremental:
+            return
+        if self.spec.get_mapping(mapping).get('incremental') is None:
+            return
+        since = Watermark.get(self._watermark_name(mapping),
+                              source_id=self.spec.source)
+        if since is not None:
+            log.info("Mapping %r incrementally, since: %r", mapping, since)
+        return since
+
+    def _update_watermark(self, stats):
+        """ Persist the highest change-tracking value seen, once all the
+        statements generated by a mapping have been loaded. """
+        if stats.get('watermark') is None:
+            return
+        Watermark.set(self._watermark_name(stats['mapping']),
+                      stats['watermark'], source_id=self.spec.source)
+
+    def _tasks(self, mapping):
+        """ Generate the worker tasks needed to map the given mapping, one for
+        each range of the mapping key. """
+        since = self.get_since(mapping)
+        ranges = [(None, None)]
+        if self.workers > 1:
+            ranges = self.generator.partitions(mapping, self.workers,
+                                               since=since)
+            log.info("Mapping %r in %s ranges", mapping, len(ranges))
+        source_id = self.spec.source
+        return [(self.config.data, self.config.path, self.spec.data,
+                 self.spec.path, source_id, mapping, start, end, since)
+                for (start, end) in ranges]
+
+    def _dispose(self):
+        """ Make sure no database connections are shared with forked worker
+        processes. """
+        self.config.engine.dispose()
+        self.spec.engine.dispose()
+
+    def _run_tasks(self, tasks, processes):
+        """ Run mapping tasks, possibly of several mappings, in one pool of
+        worker processes. The pool is always created by the main thread, as
+        forking from other threads can deadlock the children. Statistics are
+        aggregated for each mapping, and its watermark is updated once all
+        of its ranges are done. """
+        begin = time.time()
+        stats, ranges, order = {}, {}, []
+        for task in tasks:
+            mapping = task[5]
+            if mapping not in stats:
+                order.append(mapping)
+                stats[mapping] = {'mapping': mapping, 'records': 0,
+                                  'statements': 0, 'watermark': None}
+            ranges[mapping] = ranges.get(mapping, 0) + 1
+        pending = dict(ranges)
+        self._dispose()
+        pool = Pool(processes=max(1, min(processes, len(tasks))))
+        try:
+            for part in pool.imap_unordered(_map_range, tasks):
+                mapping = part['mapping']
+                if ranges[mapping] > 1:
+                    log.info("Mapped %r range [%r, %r): %s records in %.2fs",
+                             mapping, part['start'], part['end'],
+                             part['records'], part['duration'])
+                mapping_stats = stats[mapping]
+                mapping_stats['records'] += part['records']
+                mapping_stats['statements'] += part['statements']
+                mapping_stats['watermark'] = _max(mapping_stats['watermark'],
+                                                  part['watermark'])
+                pending[mapping] -= 1
+                if pending[mapping] == 0:
+                    mapping_stats['duration'] = time.time() - begin
+                    self._log_stats(mapping_stats)
+                    self._update_watermark(mapping_stats)
+        finally:
+            pool.terminate()
+            pool.join()
+        return [stats[m] for m in order]
+
+    def map_mapping(self, mapping):
+        """ Map all records of a mapping. If more than one worker is
+        configured, the records are split into ranges of the mapping key and
+        each range is mapped in a separate process. """
+        if self.workers == 1:
+            stats = self.map_range(mapping, since=self.get_since(mapping))
+            self._log_stats(stats)
+            self._update_watermark(stats)
+            return stats
+        stats, = self._run_tasks(self._tasks(mapping), self.workers)
+        return stats
 
     def map(self):
+        """ Map all mappings in the spec. In bulk mode, the indexes of the
+        statement tables are dropped during the load and re-created once all
+        mappings have been loaded. """
+        if not self.bulk:
+            return self.map_mappings()
+        managers = [self.config.types, self.config.properties]
+        for manager in managers:
+            manager.drop_indexes()
+        # Without the unique index, statements can be loaded directly into
+        # the statement tables. Duplicates are removed before re-indexing.
+        # An unset value (``None``) means the default is used again.
+        merge = self.config.data.get('copy_merge')
+        self.config['copy_merge'] = False
+        try:
+            return self.map_mappings()
+        finally:
+            self.config['copy_merge'] = merge
+            create_indexes(managers)
+
+    def map_mappings(self):
+        """ Map all mappings in the spec. If a concurrency greater than one
+        is configured, up to that many mappings are run at the same time,
+        each in its own worker process(es). """
+        if self.concurrency == 1:
+            return [self.map_mapping(m) for m in self.spec.mappings]
+
+        begin = time.time()
+        tasks = []
         for mapping in self.spec.mappings:
-            self.map_mapping(mapping)
+            tasks.extend(self._tasks(mapping))
+        # Tasks are queued mapping by mapping, so with one process for each
+        # of the workers of each concurrent mapping, about ``concurrency``
+        # mappings are being mapped at any time.
+        results = self._run_tasks(tasks, self.concurrency * self.workers)
+        log.info("Mapped %s mappings in %.2fs", len(results),
+                 time.time() - begin)
+        return results
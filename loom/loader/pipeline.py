@@ -0,0 +1,146 @@
+import sys
+import six
+import logging
+from time import time
+from threading import Thread, Event
+from Queue import Queue, Empty, Full
+
+log = logging.getLogger(__name__)
+
+# Marks the end of the items produced by a stage.
+DONE = object()
+
+
+def batched(items, size):
+    """ Group an iterable into lists of up to ``size`` items. """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch):
+        yield batch
+
+
+class Stage(object):
+    """ A single stage of a pipeline, which keeps track of the time it spends
+    working, as opposed to waiting on its neighbouring stages. """
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.items = 0
+
+    def occupancy(self, elapsed):
+        if elapsed <= 0:
+            return 0.0
+        return min(1.0, self.busy / elapsed)
+
+
+class Pipeline(object):
+    """ Run the reading of a source iterator and a sequence of processing
+    functions in separate threads, connected by bounded queues. This allows
+    waiting on I/O (e.g. the source database) to overlap with CPU-bound work.
+    The results are consumed by the caller, which forms the final stage. """
+
+    def __init__(self, name, stages, sink='write', size=10):
+        self.name = name
+        self.funcs = [func for (_, func) in stages]
+        self.stages = [Stage('fetch')]
+        self.stages.extend([Stage(n) for (n, _) in stages])
+        self.stages.append(Stage(sink))
+        self.queues = [Queue(maxsize=size) for _ in self.funcs]
+        self.queues.append(Queue(maxsize=size))
+        self.stopped = Event()
+        self.error = None
+
+    def _put(self, queue, item):
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _get(self, queue):
+        while not self.stopped.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                pass
+        return DONE
+
+    def _fetch(self, source):
+        stage, queue = self.stages[0], self.queues[0]
+        try:
+            items = iter(source)
+            while True:
+                begin = time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                stage.busy += time() - begin
+                stage.items += 1
+                if not self._put(queue, item):
+                    return
+        except Exception:
+            self.error = sys.exc_info()
+        self._put(queue, DONE)
+
+    def _process(self, index):
+        stage, func = self.stages[index + 1], self.funcs[index]
+        inq, outq = self.queues[index], self.queues[index + 1]
+        try:
+            while True:
+                item = self._get(inq)
+                if item is DONE:
+                    break
+                begin = time()
+                result = func(item)
+                stage.busy += time() - begin
+                stage.items += 1
+                if not self._put(outq, result):
+                    return
+        except Exception:
+            self.error = sys.exc_info()
+        self._put(outq, DONE)
+
+    def _start(self, target, *args):
+        thread = Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self, source):
+        """ Iterate over the results of the last processing function. """
+        begin = time()
+        threads = [self._start(self._fetch, source)]
+        for index in range(len(self.funcs)):
+            threads.append(self._start(self._process, index))
+        sink, queue = self.stages[-1], self.queues[-1]
+        try:
+            while True:
+                item = self._get(queue)
+                if item is DONE:
+                    break
+                start = time()
+                yield item
+                sink.busy += time() - start
+                sink.items += 1
+            if self.error is not None:
+                six.reraise(*self.error)
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+            self.report(time() - begin)
+
+    def report(self, elapsed):
+        """ Log how much of the time each stage was busy. The stage with the
+        highest occupancy is the bottleneck of the pipeline. """
+        stages = ', '.join(['%s %.0f%%' % (s.name, s.occupancy(elapsed) * 100)
+                            for s in self.stages])
+        log.info("Pipeline %r stage occupancy: %s", self.name, stages)
@@ -35,6 +35,10 @@ class Spec(EnvMapping):
             self._engine = create_engine(uri)
         return self._engine
 
+    @property
+    def is_postgresql(self):
+        return 'postgres' in self.engine.dialect.name
+
     @property
     def mappings(self):
         return self.get('mappings', {}).keys()
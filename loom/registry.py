@@ -0,0 +1,65 @@
+import logging
+from threading import Lock
+
+from jsonmapping import SchemaVisitor
+
+log = logging.getLogger(__name__)
+
+
+class SchemaRegistry(object):
+    """ Keep track of the inheritance relations between all known schemas.
+    The map is computed once from the documents in the resolver store, and
+    re-built only if documents are added to the store. """
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.lock = Lock()
+        self.version = None
+        self.parents = {}
+        self.children = {}
+
+    def _ancestors(self, visitor, ancestors):
+        if visitor.id is not None:
+            ancestors.add(visitor.id)
+        for parent in visitor.inherited:
+            self._ancestors(parent, ancestors)
+        return ancestors
+
+    def build(self):
+        """ Compute the parents and children of each schema in the store. """
+        parents, children = {}, {}
+        for uri, data in self.resolver.store.items():
+            if not isinstance(data, dict) or data.get('id') is None:
+                continue
+            visitor = SchemaVisitor(data, self.resolver)
+            schema = data.get('id')
+            parents[schema] = self._ancestors(visitor, set([schema]))
+            for parent in parents[schema]:
+                children.setdefault(parent, set()).add(schema)
+        self.parents, self.children = parents, children
+        # Resolving references can add documents to the store.
+        self.version = len(self.resolver.store)
+        log.debug("Indexed inheritance of %s schemas", len(parents))
+
+    def invalidate(self):
+        self.version = None
+
+    def _check(self):
+        if self.version != len(self.resolver.store):
+            with self.lock:
+                if self.version != len(self.resolver.store):
+                    self.build()
+
+    def implied_schemas(self, schema_uri):
+        """ Given a schema URI, return a list of implied (i.e. child) schema
+        URIs, with the original schema included. """
+        self._check()
+        children = self.children.get(schema_uri, set())
+        return [schema_uri] + [c for c in children if c != schema_uri]
+
+    def is_a(self, schema_uri, parent_uri):
+        """ Check if the given schema is, or inherits from, the parent. """
+        if schema_uri == parent_uri:
+            return True
+        self._check()
+        return parent_uri in self.parents.get(schema_uri, ())
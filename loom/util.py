@@ -1,7 +1,8 @@
 import six
 import os
 import yaml
-from collections import MutableMapping, Mapping
+from threading import Lock
+from collections import MutableMapping, Mapping, OrderedDict
 
 
 class LoomException(Exception):
@@ -57,3 +58,74 @@ class EnvMapping(MutableMapping):
 
     def __len__(self):
         return len(self.data)
+
+
+class LRUCache(object):
+    """ A bounded, thread-safe mapping which evicts the least recently used
+    item once it is full. Hits and misses are counted, to help with picking
+    the size of the cache. """
+
+    def __init__(self, size):
+        self.size = int(size)
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def setdefault(self, key, value):
+        """ Get the item for the given key, storing the given value first if
+        there is none. This does not count as a hit or a miss. """
+        if self.size <= 0:
+            return value
+        with self.lock:
+            value = self.data.pop(key, value)
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+            return value
+
+    def discard(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits, self.misses = 0, 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return '<LRUCache(%s/%s, %.1f%% hits)>' % \
+            (len(self), self.size, self.hit_rate * 100)
@@ -0,0 +1,30 @@
+from unittest import TestCase
+
+from loom import analysis
+from loom.analysis import extract_text, latinize
+
+
+class AnalysisTestCase(TestCase):
+
+    def test_extract_text(self):
+        data = {
+            'id': 'ignored',
+            'name': u'Foo Ltd',
+            'aliases': [u'Foo Ltd', u'Foo Limited'],
+            'address': {'country': u'GB', 'number': 12, '$text': u'x'},
+            'empty': None
+        }
+        texts = extract_text(data)
+        assert sorted(texts) == [u'12', u'Foo Limited', u'Foo Ltd', u'GB'], \
+            texts
+        assert extract_text(u'text') == [u'text']
+
+    def test_latinize_cache(self):
+        analysis.configure_cache(10)
+        cache = analysis.latin_cache
+        assert latinize(u'Foo') == u'foo'
+        assert latinize(u'Foo') == u'foo'
+        assert cache.hits == 1, cache
+        assert cache.misses == 1, cache
+        assert latinize(None) is None
+        assert latinize(u'') == u''
@@ -44,3 +44,19 @@ class ConfigTestCase(TestCase):
     def test_invalid_alias(self):
         self.config.get_alias('http://occrp.org/foo/bar.json#xxx')
         self.config.get_alias('http://foo.org/xxx/bar.json')
+
+    def test_implied_schemas(self):
+        base = {'id': 'http://test.occrp.org/schema/entity.json',
+                'type': 'object'}
+        person = {'id': 'http://test.occrp.org/schema/person.json',
+                  'type': 'object', 'allOf': [{'$ref': base['id']}]}
+        self.config.add_schema(base)
+        implied = self.config.implied_schemas(base['id'])
+        assert implied == [base['id']], implied
+        self.config.add_schema(person)
+        implied = self.config.implied_schemas(base['id'])
+        assert person['id'] in implied, implied
+        implied = self.config.implied_schemas(person['id'])
+        assert implied == [person['id']], implied
+        assert self.config.is_a(person['id'], base['id'])
+        assert not self.config.is_a(base['id'], person['id'])
@@ -1,12 +1,15 @@
 import os
+import tempfile
+from datetime import datetime, timedelta
 from unittest import TestCase
+from sqlalchemy import event
 
 from util import create_fixtures, FIXTURE_PATH
 
-from loom.db import Source, session
+from loom.db import Source, EntityRight, AsyncEntityManager, session
 from loom.config import Config
 from loom.loader import Spec, Mapper
-from loom.util import load_config
+from loom.util import load_config, LRUCache
 
 
 class MapperTestCase(TestCase):
@@ -21,6 +24,12 @@ class MapperTestCase(TestCase):
         self.spec._engine = self.engine
         self.mapper = Mapper(self.config, self.spec)
         self.gen = self.mapper.generator
+        self.temp_files = []
+
+    def tearDown(self):
+        for path in self.temp_files:
+            if os.path.exists(path):
+                os.unlink(path)
 
     def test_create_source(self):
         source = {'slug': 'foo', 'title': 'Foo source', 'url': 'http://foo'}
@@ -40,3 +49,209 @@ class MapperTestCase(TestCase):
         assert len(self.config.types) == 0, len(self.config.types)
         self.config.entities.save(schema['id'], entity, 'foo_source')
         assert len(self.config.types) == 1, len(self.config.types)
+
+    def test_terms(self):
+        terms = self.config.terms
+        id = terms.encode(u'http://test.occrp.org/schema/person.json')
+        assert isinstance(id, int), id
+        again = terms.encode(u'http://test.occrp.org/schema/person.json')
+        assert again == id, again
+        assert terms.encode(u'unknown term', create=False) is None
+        terms.ids.clear()
+        terms.values.clear()
+        value = terms.decode(id)
+        assert value == u'http://test.occrp.org/schema/person.json', value
+
+    def test_save_encoded(self):
+        schema = self.spec.get('mappings').get('companies').get('schema')
+        self.config.add_schema(schema)
+        entity = {'id': 'encoded', 'name': 'Encoded entity'}
+        self.config.entities.save(schema['id'], entity, author=u'tester')
+        q = 'SELECT predicate, author FROM property WHERE subject = ?'
+        rows = self.engine.execute(q, 'encoded').fetchall()
+        terms = self.config.terms
+        predicates = [terms.decode(r.predicate) for r in rows]
+        assert 'name' in predicates, predicates
+        assert terms.decode(rows[0].author) == 'tester', rows
+        data = self.config.entities.get('encoded')
+        assert data['name'] == 'Encoded entity', data
+        assert data['$schema'] == schema['id'], data
+
+    def test_get_schema(self):
+        schema = self.spec.get('mappings').get('companies').get('schema')
+        self.config.add_schema(schema)
+        entity = {'id': 'schema_test', 'name': 'Schema test'}
+        self.config.entities.save(schema['id'], entity, source_id=7)
+        found = self.config.entities.get_schema('schema_test')
+        assert found == schema['id'], found
+        right = EntityRight(collections=[], sources=[7])
+        found = self.config.entities.get_schema('schema_test', right=right)
+        assert found == schema['id'], found
+        right = EntityRight(collections=[], sources=[8])
+        found = self.config.entities.get_schema('schema_test', right=right)
+        assert found is None, found
+
+    def test_statement_cache(self):
+        schema = self.spec.get('mappings').get('companies').get('schema')
+        self.config.add_schema(schema)
+        entities = self.config.entities
+        entities.cache = LRUCache(2)
+        entity = {'id': 'cached', 'name': 'Cached entity'}
+        entities.save(schema['id'], entity)
+        assert entities.get('cached')['name'] == 'Cached entity'
+        assert entities.get('cached')['name'] == 'Cached entity'
+        assert entities.cache.hits == 1, entities.cache.hits
+        entity['name'] = 'Changed entity'
+        entities.save(schema['id'], entity)
+        assert 'cached' not in entities.cache, entities.cache.data
+        data = entities.get('cached')
+        assert data['name'] == 'Changed entity', data
+        right = EntityRight(collections=[], sources=[None])
+        entities.load_statements(['cached'], right=right)
+        assert len(entities.cache.data['cached']) == 2, entities.cache.data
+        entities.invalidate('cached')
+        assert 'cached' not in entities.cache, entities.cache.data
+        entities.remove('cached')
+        assert entities.get('cached', schema=schema['id'])['$attrcount'] == 0
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert 'b' not in cache, cache.data
+        assert cache.get('b') is None
+        assert cache.hits == 1 and cache.misses == 1, cache
+        assert len(cache) == 2, len(cache)
+        assert cache.setdefault('a', 4) == 1
+        assert cache.setdefault('d', 4) == 4
+        assert 'c' not in cache, cache.data
+        assert cache.hits == 1 and cache.misses == 1, cache
+
+    def test_save_batched(self):
+        schema = self.spec.get('mappings').get('companies').get('schema')
+        self.config.add_schema(schema)
+        entities = self.config.entities
+        entity = {'id': 'nested', 'name': 'Nested',
+                  'financials': {'id': 'nested_fin', 'price': 12.5}}
+        queries = []
+
+        def count(conn, cursor, statement, *args):
+            if statement.startswith('SELECT') and \
+                    ('FROM entity' in statement or
+                     'FROM property' in statement):
+                queries.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', count)
+        try:
+            entities.save(schema['id'], entity)
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', count)
+        assert len(queries) == 2, queries
+        schemas = entities.get_schemas(['nested', 'nested_fin', 'missing'])
+        assert schemas.get('nested') == schema['id'], schemas
+        assert 'nested_fin' in schemas, schemas
+        assert 'missing' not in schemas, schemas
+
+    def test_right_filter(self):
+        schema = self.spec.get('mappings').get('companies').get('schema')
+        self.config.add_schema(schema)
+        entities = self.config.entities
+        entity = {'id': 'righted', 'name': 'Righted entity'}
+        entities.save(schema['id'], entity, source_id=7, author=u'editor')
+        right = EntityRight(sources=[7])
+        data = entities.get('righted', right=right)
+        assert data['name'] == 'Righted entity', data
+        right = EntityRight(author=u'editor')
+        data = entities.get('righted', right=right)
+        assert data['name'] == 'Righted entity', data
+        right = EntityRight(sources=[8], author=u'nobody')
+        assert entities.get('righted', right=right) is None
+        data = entities.get('righted', schema=schema['id'], right=right)
+        assert 'name' not in data, data
+        right = EntityRight()
+        assert entities.get('righted', right=right) is None
+        subjects = list(entities.subjects(schema['id'], right=right))
+        assert not len(subjects), subjects
+        table = self.config.properties.table
+        q = table.select().where(table.c.subject == u'righted')
+        row = self.engine.execute(q).first()
+        right = EntityRight(author=u'editor')
+        assert right.check(row, terms=self.config.terms)
+        right = EntityRight(author=u'nobody')
+        assert not right.check(row, terms=self.config.terms)
+
+    def test_async_manager(self):
+        # Threads cannot share the in-memory fixture database.
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.temp_files.append(path)
+        config = Config({'database': 'sqlite:///%s' % path})
+        config.setup()
+        schema = self.spec.get('mappings').get('companies').get('schema')
+        config.add_schema(schema)
+        manager = AsyncEntityManager(config.entities, threads=2)
+        try:
+            entity = {'id': 'async', 'name': 'Async entity',
+                      'financials': {'id': 'async_fin', 'price': 3.5}}
+            manager.save(schema['id'], entity).get()
+            data = manager.get('async', depth=2).get()
+            assert data['name'] == 'Async entity', data
+            assert data['financials']['price'] == '3.5', data
+            schemas = manager.get_schemas(['async', 'missing']).get()
+            assert schemas == {'async': schema['id']}, schemas
+            subjects = manager.subjects(schema['id'], limit=1).get()
+            assert subjects == [('async', schema['id'])], subjects
+        finally:
+            manager.close()
+            config.engine.dispose()
+            self.config.setup()
+
+    def test_subject_changes(self):
+        schema = self.spec.get('mappings').get('companies').get('schema')
+        self.config.add_schema(schema)
+        entities = self.config.entities
+        entity = {'id': 'changed', 'name': 'Changed',
+                  'financials': {'id': 'changed_fin', 'price': 1.0}}
+        entities.save(schema['id'], entity,
+                      created_at=datetime(2001, 1, 1))
+        since = entities.last_change()
+        assert since is not None, since
+        entity = {'id': 'changed_fin', 'name': 'Changed financials'}
+        entities.save(schema['id'], entity,
+                      created_at=since + timedelta(seconds=1))
+        changed = entities.changed_subjects(since)
+        assert changed == set(['changed_fin']), changed
+        linking = entities.linking_subjects(changed)
+        assert linking == set(['changed']), linking
+
+    def test_subject_removals(self):
+        schema = self.spec.get('mappings').get('companies').get('schema')
+        self.config.add_schema(schema)
+        entities = self.config.entities
+        since = datetime.utcnow() - timedelta(seconds=1)
+        entities.save(schema['id'], {'id': 'removed', 'name': 'Removed'},
+                      source_id=99)
+        entities.save(schema['id'], {'id': 'flushed', 'name': 'Flushed'},
+                      source_id=99)
+        assert 'removed' not in entities.removed_subjects(since)
+        entities.remove('removed')
+        removed = entities.removed_subjects(since, source_id=99)
+        assert 'removed' in removed, removed
+        assert 'flushed' not in removed, removed
+        entities.flush(source_id=99)
+        assert entities.get_schema('flushed') is None
+        removed = entities.removed_subjects(since, source_id=99)
+        assert 'flushed' in removed, removed
+        assert entities.removed_subjects(datetime.utcnow()) == set()
+        assert entities.last_change() >= since
+
+    def test_save_reverted(self):
+        schema = self.spec.get('mappings').get('companies').get('schema')
+        self.config.add_schema(schema)
+        entities = self.config.entities
+        for i, name in enumerate(['A', 'B', 'A']):
+            entities.save(schema['id'], {'id': 'reverted', 'name': name},
+                          created_at=datetime(2010, 1, 1 + i))
+        entity = entities.get('reverted')
+        assert entity['name'] == 'A', entity
@@ -1,11 +1,17 @@
 import os
+import copy
+import tempfile
 from nose.tools import raises
 from unittest import TestCase
 
-from util import create_fixtures, FIXTURE_PATH
+from util import create_fixtures, load_fixtures, FIXTURE_PATH
 
+from sqlalchemy import inspect, event
+
+from loom.db import Watermark, session
 from loom.config import Config
 from loom.loader import Spec, Mapper
+from loom.indexer import Indexer
 from loom.util import SpecException, ConfigException, load_config
 
 
@@ -21,9 +27,18 @@ class MapperTestCase(TestCase):
         self.spec._engine = self.engine
         self.mapper = Mapper(self.config, self.spec)
         self.gen = self.mapper.generator
+        self.temp_files = []
 
     def tearDown(self):
-        pass
+        for path in self.temp_files:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _temp_db(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.temp_files.append(path)
+        return 'sqlite:///%s' % path
 
     @raises(SpecException)
     def test_invalid_table(self):
@@ -65,3 +80,174 @@ class MapperTestCase(TestCase):
         assert '$schema' in data, data
         assert data['name'] == '3M Co', data
         assert len(self.config.types) > 900, len(self.config.types)
+
+    def test_get_batched(self):
+        self.mapper.map()
+        queries = []
+
+        def count(conn, cursor, statement, *args):
+            if 'FROM property' in statement:
+                queries.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', count)
+        try:
+            data = self.config.entities.get('sp500:MMM:MMM', depth=2)
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', count)
+        assert data['financials']['price'], data
+        assert len(queries) == 2, queries
+
+    def test_generate_paginated(self):
+        self.spec['chunk'] = 50
+        mapping = self.spec.get('mappings').get('companies', raw=True)
+        mapping['key'] = 'companies.symbol'
+        comps = [e for e in self.gen.generate('companies')]
+        assert len(comps) == 496, len(comps)
+        symbols = set([c['companies.symbol'] for c in comps])
+        assert len(symbols) == 496, len(symbols)
+
+    def test_partitions(self):
+        mapping = self.spec.get('mappings').get('companies', raw=True)
+        mapping['key'] = 'companies.symbol'
+        ranges = self.gen.partitions('companies', 4)
+        assert len(ranges) == 4, ranges
+        assert ranges[0][0] is None, ranges
+        assert ranges[-1][1] is None, ranges
+        total = 0
+        for (start, end) in ranges:
+            total += len(list(self.gen.generate('companies', start=start,
+                                                end=end)))
+        assert total == 496, total
+
+    @raises(SpecException)
+    def test_partitions_no_key(self):
+        self.gen.partitions('companies', 4)
+
+    def test_map_incremental(self):
+        mapping = self.spec.get('mappings').get('companies', raw=True)
+        mapping['incremental'] = 'companies.symbol'
+        stats = self.mapper.map_mapping('companies')
+        assert stats['records'] == 496, stats
+        assert stats['watermark'] == 'ZTS', stats
+        watermark = Watermark.get('mapping:companies',
+                                  source_id=self.spec.source)
+        assert watermark == 'ZTS', watermark
+        Watermark.set('mapping:companies', 'YUM', source_id=self.spec.source)
+        stats = self.mapper.map_mapping('companies')
+        assert stats['records'] == 3, stats
+        stats = self.mapper.map_mapping('companies')
+        assert stats['records'] == 0, stats
+        mapper = Mapper(self.config, self.spec, incremental=False)
+        stats = mapper.map_mapping('companies')
+        assert stats['records'] == 496, stats
+
+    def test_map_bulk(self):
+        mapper = Mapper(self.config, self.spec, bulk=True)
+        mapper.map()
+        assert self.config.get('copy_merge') is None, self.config.data
+        self.config['copy_merge'] = True
+        mapper.map()
+        assert self.config['copy_merge'] is True, self.config.data
+        del self.config['copy_merge']
+        q = 'SELECT COUNT(*) FROM entity WHERE subject = \'sp500:MMM:MMM\''
+        count = self.engine.execute(q).scalar()
+        assert count == 1, count
+        indexes = inspect(self.engine).get_indexes('property')
+        names = [i['name'] for i in indexes]
+        assert 'ix_property_hash' in names, names
+
+    def test_map_concurrent(self):
+        # Worker processes cannot share the in-memory fixture database.
+        config = Config({'database': self._temp_db()})
+        session.remove()
+        config.setup()
+        data = load_config(os.path.join(FIXTURE_PATH, 'spec.yaml'))
+        data['database'] = self._temp_db()
+        load_fixtures(data['database']).dispose()
+        mappings = data['mappings']
+        mappings['companies']['key'] = 'companies.symbol'
+        mappings['companies']['incremental'] = 'companies.symbol'
+        mappings['names'] = copy.deepcopy(mappings['companies'])
+        mappings['names']['incremental'] = 'companies.name'
+        spec = Spec(config, data)
+        try:
+            mapper = Mapper(config, spec, workers=2, concurrency=2)
+            results = mapper.map()
+            stats = {s['mapping']: s for s in results}
+            assert sorted(stats.keys()) == ['companies', 'names'], results
+            for name, watermark in [('companies', 'ZTS'),
+                                    ('names', 'salesforce.com inc')]:
+                assert stats[name]['records'] == 496, stats[name]
+                assert stats[name]['watermark'] == watermark, stats[name]
+                value = Watermark.get('mapping:%s' % name,
+                                      source_id=spec.source)
+                assert value == watermark, (name, value)
+        finally:
+            session.remove()
+            config.engine.dispose()
+            spec.engine.dispose()
+            self.config.setup()
+
+    def test_subjects_paged(self):
+        self.mapper.map()
+        schema = 'http://test.occrp.org/schema/company.json'
+        entities = self.config.entities
+        subjects = list(entities.subjects(schema))
+        assert len(subjects) > 400, len(subjects)
+        assert subjects == sorted(subjects), subjects[:5]
+        names = [s for (s, _) in subjects]
+        assert len(names) == len(set(names)), len(names)
+        paged = list(entities.subjects(schema, chunk=37))
+        assert paged == subjects, len(paged)
+        resumed = list(entities.subjects(schema, after=names[99]))
+        assert resumed == subjects[100:], len(resumed)
+        ranged = list(entities.subjects(schema, start=names[10],
+                                        end=names[20]))
+        assert ranged == subjects[10:20], ranged
+        shards = [list(entities.subjects(schema, shard=(i, 3)))
+                  for i in range(3)]
+        assert sum([len(s) for s in shards]) == len(subjects), shards
+        assert sorted(shards[0] + shards[1] + shards[2]) == subjects
+
+    def test_generate_sharded(self):
+        self.mapper.map()
+        self.config['elastic_index'] = 'loom_test'
+        indexer = Indexer(self.config, workers=2)
+        schema = 'http://test.occrp.org/schema/company.json'
+        counts = []
+        docs = []
+        for i in range(2):
+            shard = list(indexer.generate_entities(schema, None,
+                                                   shard=(i, 2),
+                                                   progress=counts.append))
+            docs.extend([d['_id'] for d in shard])
+        assert len(docs) == len(set(docs)), len(docs)
+        subjects = list(self.config.entities.subjects(schema))
+        assert len(docs) == len(subjects), len(docs)
+
+    def test_iterate_entities(self):
+        self.mapper.map()
+        schema = 'http://test.occrp.org/schema/company.json'
+        entities = self.config.entities
+        queries = []
+
+        def count(conn, cursor, statement, *args):
+            if 'FROM property' in statement:
+                queries.append(statement)
+        event.listen(self.engine, 'before_cursor_execute', count)
+        try:
+            items = list(entities.iterate(schema, chunk=100))
+            depth1 = len(queries)
+            deep = list(entities.iterate(schema, chunk=100, depth=2))
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', count)
+        subjects = list(entities.subjects(schema))
+        assert len(items) == len(subjects), len(items)
+        pages = (len(subjects) + 99) // 100
+        # One query per page, and one more per page for linked entities:
+        assert depth1 == pages, depth1
+        assert len(queries) - depth1 == pages * 2, len(queries)
+        for subject, item_schema, data in items[:20]:
+            assert data == entities.get(subject, schema=item_schema), data
+        for subject, item_schema, data in deep[:20]:
+            assert data == entities.get(subject, schema=item_schema,
+                                        depth=2), data
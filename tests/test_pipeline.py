@@ -0,0 +1,36 @@
+from nose.tools import raises
+from unittest import TestCase
+
+from loom.loader.pipeline import Pipeline, batched
+
+
+def _fail(item):
+    raise ValueError(item)
+
+
+class PipelineTestCase(TestCase):
+
+    def test_batched(self):
+        batches = list(batched(range(25), 10))
+        assert len(batches) == 3, batches
+        assert batches[-1] == range(20, 25), batches
+
+    def test_run_stages(self):
+        pipeline = Pipeline('test', [('double', lambda x: x * 2),
+                                     ('inc', lambda x: x + 1)], size=2)
+        results = list(pipeline.run(range(100)))
+        assert results == [(x * 2) + 1 for x in range(100)], results
+        assert pipeline.stages[1].items == 100, pipeline.stages[1].items
+        occupancy = pipeline.stages[0].occupancy(1.0)
+        assert occupancy >= 0 and occupancy <= 1.0, occupancy
+
+    @raises(ValueError)
+    def test_stage_error(self):
+        pipeline = Pipeline('test', [('fail', _fail)])
+        list(pipeline.run(range(10)))
+
+    def test_stop_early(self):
+        pipeline = Pipeline('test', [('same', lambda x: x)], size=1)
+        for item in pipeline.run(xrange(100000)):
+            break
+        assert pipeline.stopped.is_set()
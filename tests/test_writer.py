@@ -0,0 +1,167 @@
+import struct
+from hashlib import md5
+from nose.tools import raises, assert_raises
+from threading import Thread
+from unittest import TestCase
+from sqlalchemy import create_engine, inspect, Index, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from util import create_fixtures
+
+from loom.db import Property, migrate
+from loom.config import Config
+from loom.util import ConfigException
+from loom.db.util import statement_hash
+from loom.db.migrate import is_outdated
+from loom.db.writer import CopyStream, _binary_encoder
+
+
+class WriterTestCase(TestCase):
+
+    def setUp(self):
+        self.config = Config({'insert_chunk': 100,
+                              'sqlite_bulk_pragmas': True})
+        self.config._engine = create_fixtures()
+        self.config.setup()
+
+    def test_batched_insert(self):
+        before = len(self.config.properties)
+        writer = self.config.properties.writer()
+        for i in range(250):
+            writer.write({'subject': u'batch:%s' % i, 'predicate': u'name',
+                          'object': u'Batch %s' % i, 'type': u'string',
+                          'source_id': 1})
+        assert len(self.config.properties) == before + 200
+        writer.flush()
+        assert len(self.config.properties) == before + 250
+        assert writer.conn is None
+        sync = self.config.engine.execute('PRAGMA synchronous').scalar()
+        assert sync != 0, sync
+
+    def test_copy_stream(self):
+        stream = CopyStream(size=2)
+        stream.BLOCK_SIZE = 10
+        data = []
+
+        def read():
+            while True:
+                block = stream.read(8192)
+                if not len(block):
+                    return
+                data.append(block)
+
+        thread = Thread(target=read)
+        thread.start()
+        for i in range(1000):
+            stream.write(b'row %s\n' % i)
+        stream.close()
+        thread.join()
+        lines = b''.join(data).splitlines()
+        assert len(lines) == 1000, len(lines)
+        assert lines[-1] == b'row 999', lines[-1]
+
+    @raises(ValueError)
+    def test_copy_stream_abort(self):
+        stream = CopyStream(size=1)
+        stream.abort(ValueError('failed'))
+        stream.write(b'x' * (stream.BLOCK_SIZE + 1))
+
+    def test_binary_encoder(self):
+        columns = Property.__table__.columns
+        value = _binary_encoder(columns['source_id'])(5)
+        assert value == struct.pack('!i', 5), repr(value)
+        value = _binary_encoder(columns['subject'])(u'b\xe4r')
+        assert value == u'b\xe4r'.encode('utf-8'), repr(value)
+        value = _binary_encoder(columns['id'])(5)
+        assert len(value) == 8, repr(value)
+
+    def test_covering_index(self):
+        table = Property.__table__
+        index = Index('ix_test_covering', table.c.object,
+                      info={'include': ['subject']},
+                      postgresql_where=text("type = 'link'"))
+        dialect = postgresql.dialect()
+        dialect.server_version_info = (11, 2)
+        sql = str(CreateIndex(index).compile(dialect=dialect))
+        assert "(object) INCLUDE (subject) WHERE type = 'link'" in sql, sql
+        dialect.server_version_info = (10, 5)
+        sql = str(CreateIndex(index).compile(dialect=dialect))
+        assert 'INCLUDE' not in sql, sql
+        table.indexes.discard(index)
+
+    def test_dedupe(self):
+        table = self.config.types.table
+        row = {'subject': u'dupe:2', 'schema': 1, 'source_id': 1}
+        self.config.engine.execute(table.insert(), [row, row, row])
+        q = table.select().where(table.c.subject == u'dupe:2')
+        assert len(self.config.engine.execute(q).fetchall()) == 3
+        conn = self.config.engine.connect()
+        self.config.types.dedupe(conn)
+        conn.close()
+        rows = self.config.engine.execute(q).fetchall()
+        assert len(rows) == 1, rows
+        assert rows[0].hash == statement_hash(row, self.config.types.cls.KEY)
+        assert self.config.types.hash_index is not None
+        # A row without a hash which duplicates a hashed statement:
+        self.config.engine.execute(table.insert(), [row])
+        conn = self.config.engine.connect()
+        self.config.types.dedupe(conn)
+        conn.close()
+        assert len(self.config.engine.execute(q).fetchall()) == 1
+
+    def test_merge_query(self):
+        writer = self.config.types.writer()
+        q = writer.merge_query('entity_stage')
+        assert 'FROM entity_stage' in q, q
+        assert 'ON CONFLICT (hash) DO UPDATE' in q, q
+        assert 'DISTINCT ON (hash)' in q, q
+
+    def test_skip_duplicates(self):
+        before = len(self.config.types)
+        row = {'subject': u'dupe:1', 'schema': u'http://x.org/y.json',
+               'source_id': 1}
+        self.config.types.insert_many([dict(row), dict(row)])
+        assert len(self.config.types) == before + 1
+        writer = self.config.types.writer()
+        writer.write(dict(row))
+        writer.flush()
+        assert len(self.config.types) == before + 1
+
+    def test_statement_hash(self):
+        row = {'subject': u'foo', 'source_id': 5}
+        value = statement_hash(row, ('subject', 'author', 'source_id'))
+        assert value == md5(u'foo\x1f\x1f5').hexdigest(), value
+        assert len(value) == 32, value
+
+    def test_upgrade(self):
+        config = Config({})
+        config._engine = create_engine('sqlite://')
+        config.engine.execute("""CREATE TABLE entity (id INTEGER PRIMARY KEY,
+            subject VARCHAR(1024), schema VARCHAR(255), source_id INTEGER,
+            collection_id INTEGER, author VARCHAR(512),
+            created_at DATETIME)""")
+        config.engine.execute("""CREATE TABLE property (
+            id INTEGER PRIMARY KEY, subject VARCHAR(1024),
+            predicate VARCHAR(255), object VARCHAR, type VARCHAR(32),
+            source_id INTEGER, collection_id INTEGER, author VARCHAR(512),
+            created_at DATETIME)""")
+        config.engine.execute("CREATE INDEX ix_property_predicate "
+                              "ON property (predicate)")
+        q = "INSERT INTO property (subject, predicate, object) VALUES " \
+            "('a', 'name', 'x'), ('a', 'name', 'x'), ('a', 'alias', 'x')"
+        config.engine.execute(q)
+        assert is_outdated(config.properties)
+        assert_raises(ConfigException, config.setup)
+        migrate.upgrade(config)
+        assert not is_outdated(config.properties)
+        assert len(config.properties) == 2, len(config.properties)
+        q = "SELECT predicate FROM property ORDER BY id"
+        ids = [r[0] for r in config.engine.execute(q)]
+        values = [config.terms.decode(i) for i in ids]
+        assert values == [u'name', u'alias'], values
+        indexes = inspect(config.engine).get_indexes('property')
+        unique = [i['column_names'] for i in indexes if i['unique']]
+        assert unique == [['hash']], indexes
+        names = [i['name'] for i in indexes]
+        assert 'ix_property_predicate' not in names, names